@@ -1,5 +1,9 @@
 from ai4teaching.utils.utils import log
 
+from ai4teaching.models.openai_client import configure_openai_client, get_openai_client, get_async_openai_client, set_openai_client, set_async_openai_client
+from ai4teaching.models.rate_limiter import RateLimitScheduler, configure_rate_limits, get_rate_limit_scheduler, without_client_retries, create_chat_completion, acreate_chat_completion
+from ai4teaching.utils.sqlite_lru_store import SQLiteLRUStore
+from ai4teaching.models.embedding_cache import EmbeddingCache
 from ai4teaching.models.embedding_model import EmbeddingModel
 from ai4teaching.models.llm import LargeLanguageModel
 
@@ -11,23 +15,30 @@ from ai4teaching.processing.pdf_reader import PDFReader
 from ai4teaching.processing.text_chunker import TextChunker
 from ai4teaching.processing.text_embedder import TextEmbedder
 
+from ai4teaching.document_processors.processing_pipeline import ProcessingPipeline
 from ai4teaching.document_processors.document_processor import DocumentProcessor
 from ai4teaching.document_processors.video_processor import VideoProcessor
 from ai4teaching.document_processors.notion_processor import NotionProcessor
 from ai4teaching.document_processors.pdf_processor import PDFProcessor
 
+from ai4teaching.knowledge_base.index_store import JSONIndexStore, SQLiteIndexStore
 from ai4teaching.knowledge_base.knowledge_base import KnowledgeBase
 
+from ai4teaching.assistants.chat_history import ChatHistory
+from ai4teaching.assistants.context_assembler import ContextAssembler
 from ai4teaching.assistants.assistant import Assistant
 from ai4teaching.assistants.video_assistant import VideoAssistant
 from ai4teaching.assistants.quiz_assistant import QuizAssistant
 from ai4teaching.assistants.openai_assistant import OpenAIAssistant
+from ai4teaching.assistants.grading_cache import GradingCache
 from ai4teaching.assistants.grading_assistant import GradingAssistant
 from ai4teaching.assistants.chatgpt_assistant import ChatGPTAssistant
 from ai4teaching.assistants.retrieval_assistant import RetrievalAssistant
 
 from ai4teaching.vector_db.vector_db import VectorDB
 from ai4teaching.vector_db.chroma_db import ChromaDB
+from ai4teaching.vector_db.numpy_db import NumpyVectorDB
+from ai4teaching.vector_db.ivf_db import IVFVectorDB
 
 
 
@@ -1,8 +1,14 @@
 import os
 import json
+import time
 from ai4teaching.utils import log
 
 class Assistant:
+
+    # The OpenAI client and the rate limits are shared by all assistants of the process and configured only once
+    _openai_client_configured = False
+    _rate_limits_configured = False
+
     def __init__(self, config_file, depending_on_assistant=None):
         self.config_file = config_file
 
@@ -15,12 +21,31 @@ class Assistant:
         self._setup()
     
     def _setup(self):
+
+        # Settings for the shared OpenAI client (connection pool size, timeouts, retries)
+        if "openai_client" in self.config:
+            if not Assistant._openai_client_configured:
+                from ai4teaching import configure_openai_client
+                configure_openai_client(**self.config["openai_client"])
+                Assistant._openai_client_configured = True
+            else:
+                log(f"OpenAI client is already configured, ignoring the settings in >{self.config_file}<", type="debug")
+
+        # Requests and tokens per minute for each model, shared by all assistants
+        if "rate_limits" in self.config:
+            if not Assistant._rate_limits_configured:
+                from ai4teaching import configure_rate_limits
+                rate_limits_config = dict(self.config["rate_limits"])
+                configure_rate_limits(rate_limits_config.pop("limits", None), **rate_limits_config)
+                Assistant._rate_limits_configured = True
+            else:
+                log(f"Rate limits are already configured, ignoring the settings in >{self.config_file}<", type="debug")
         
         if "embedding_model" in self.config:
             if self.config["embedding_model"] == "text-embedding-ada-002":
                 # Set up the embedding model
                 from ai4teaching import EmbeddingModel
-                self.embedding_model = EmbeddingModel()
+                self.embedding_model = EmbeddingModel(cache=self._create_embedding_cache())
             else:
                 log(f"Unsupported embedding model '{self.config['embedding_model']}'.", type="error")
 
@@ -43,22 +68,104 @@ class Assistant:
         if "knowledge_base" in self.config:
             knowledge_base_index_file = self.config["knowledge_base"]["index_file"]
             from ai4teaching import KnowledgeBase
-            self.knowledge_base = KnowledgeBase(knowledge_base_index_file, self.embedding_model, self.llm)
+
+            # In background mode, processing starts once the vector database can take the results
+            processing_mode = self.config["knowledge_base"].get("processing_mode", KnowledgeBase.PROCESSING_MODE_BLOCKING)
+            initial_processing_mode = KnowledgeBase.PROCESSING_MODE_LAZY if processing_mode == KnowledgeBase.PROCESSING_MODE_BACKGROUND else processing_mode
+            self.knowledge_base = KnowledgeBase(knowledge_base_index_file, self.embedding_model, self.llm, processing_mode=initial_processing_mode)
 
          # Set up the vector database
         if "vector_db" in self.config:
             vector_db_type = self.config["vector_db"]["type"]
             vector_db_path = self.config["vector_db"]["path"]
+
+            # In sync mode, the persisted vector database is kept and only changes are applied
+            sync = self.config["vector_db"].get("sync", False)
+
             if vector_db_type == "chromadb":
                 from ai4teaching import ChromaDB
-                self.vector_db = ChromaDB(vector_db_path, self.embedding_model, reset=True)
+                self.vector_db = ChromaDB(vector_db_path, self.embedding_model, reset=not sync)
+            elif vector_db_type == "numpy":
+                from ai4teaching import NumpyVectorDB
+                self.vector_db = NumpyVectorDB(vector_db_path, self.embedding_model, reset=not sync)
+            elif vector_db_type == "ivf":
+                from ai4teaching import IVFVectorDB
+                self.vector_db = IVFVectorDB(
+                    vector_db_path, 
+                    self.embedding_model, 
+                    reset=not sync, 
+                    n_lists=self.config["vector_db"].get("n_lists"),
+                    nprobe=self.config["vector_db"].get("nprobe", 8)
+                    )
             
             embedded_chunks_file_list = self.knowledge_base.get_embedded_chunks_files()
-            for embedded_chunks_file in embedded_chunks_file_list:
-                self.vector_db.add_embedded_document_chunks(embedded_chunks_file)
+            if sync:
+                self.vector_db.sync_embedded_chunks_files(embedded_chunks_file_list)
+            else:
+                self.vector_db.add_embedded_document_chunks_files(embedded_chunks_file_list)
             
             log(f"Added {self.vector_db.get_documents_count()} document chunks to {vector_db_type}.", type="success")
 
+        if "knowledge_base" in self.config and processing_mode == KnowledgeBase.PROCESSING_MODE_BACKGROUND:
+            if "vector_db" in self.config:
+                self.knowledge_base.add_document_processed_callback(self._update_vector_db_for_document)
+            self.knowledge_base.start_background_processing()
+
+    '''
+    The shared client is looked up on every use, so that assistants always send their
+    requests with the current client, also after it was configured again
+    '''
+    @property
+    def openai_client(self):
+        from ai4teaching import get_openai_client
+        return get_openai_client()
+
+    def _update_vector_db_for_document(self, document):
+        # Called on the knowledge base worker thread after a document was processed
+        if self.config["vector_db"].get("sync", False):
+            self.vector_db.sync_embedded_chunks_files(self.knowledge_base.get_embedded_chunks_files())
+            return
+
+        from ai4teaching import DocumentProcessor
+        embedded_chunks_file = document.get("processing_outputs", {}).get(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS)
+        if embedded_chunks_file is None:
+            return
+
+        # Documents that were processed before are already loaded since startup
+        if self.vector_db.is_file_loaded(embedded_chunks_file):
+            log(f"Chunks of >{document.get('title')}< are already in the vector database", type="debug")
+            return
+
+        self.vector_db.add_embedded_document_chunks(embedded_chunks_file)
+
+    def _create_embedding_cache(self):
+        from ai4teaching import EmbeddingCache
+        return self._create_cache("embedding_cache", EmbeddingCache, "embedding_cache.sqlite", 500000)
+
+    '''
+    Creates a cache of cache_class from the config section config_key, or returns None
+    if the config has no such section
+    '''
+    def _create_cache(self, config_key, cache_class, default_file_name, default_max_entries):
+        if config_key not in self.config:
+            return None
+
+        # Relative cache paths are resolved against the directory of the config file
+        cache_config = self.config[config_key]
+        cache_path = os.path.join(self.root_path, cache_config.get("path", default_file_name))
+        return cache_class(cache_path, max_entries=cache_config.get("max_entries", default_max_entries))
+
+    def _create_chat_history(self):
+        # Bounds the tokens of the conversation that are sent with each request
+        from ai4teaching import ChatHistory
+        chat_history_config = self.config.get("chat_history", {})
+        return ChatHistory(
+            summary_model=chat_history_config.get("summary_model", "gpt-3.5-turbo-1106"),
+            token_budget=chat_history_config.get("token_budget", 3000),
+            keep_recent_messages=chat_history_config.get("keep_recent_messages", 4),
+            summary_max_tokens=chat_history_config.get("summary_max_tokens", 500)
+        )
+
     def _check_if_expected_properties_exist_in_config(self, expected_properties):
         # Read the config JSON file
         with open(self.config_file, encoding="utf-8") as config_file:
@@ -82,9 +189,56 @@ class Assistant:
             "assistant_name": self.config['assistant_name']
         }
     
-    def get_list_of_vector_db_documents(self):
+    '''
+    Streams a chat completion and yields the content tokens as they arrive. When the stream
+    ends (or the consumer stops early), on_complete is called with the full text. Time to
+    first token and total time are stored in self.last_stream_metrics
+    '''
+    def _stream_chat_completion(self, model, messages, on_complete):
+        start = time.perf_counter()
+        time_to_first_token = None
+        content_parts = []
+
+        try:
+            from ai4teaching import RateLimitScheduler, create_chat_completion
+            stream = create_chat_completion(
+                self.openai_client,
+                priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
+                model=model,
+                messages=messages,
+                stream=True
+            )
+
+            for chunk in stream:
+                if len(chunk.choices) == 0:
+                    continue
+
+                token = chunk.choices[0].delta.content
+                if token:
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start
+                    content_parts.append(token)
+                    yield token
+        finally:
+            self.last_stream_metrics = {
+                "model" : model,
+                "time_to_first_token" : time_to_first_token,
+                "total_time" : time.perf_counter() - start,
+                "num_chunks" : len(content_parts)
+            }
+
+            if len(content_parts) > 0:
+                on_complete("".join(content_parts))
+
+            if time_to_first_token is not None:
+                log(f"Streamed {len(content_parts)} chunks from {model}, time to first token {time_to_first_token:.2f} s", type="debug")
+
+    def get_last_stream_metrics(self):
+        return getattr(self, "last_stream_metrics", None)
+
+    def get_list_of_vector_db_documents(self, include=None, limit=None, offset=0):
         if self.vector_db is None:
             log(f"Assistant does not have a vector database.", type="warning")
             return None
         
-        return self.vector_db.get_documents()
\ No newline at end of file
+        return self.vector_db.get_documents(include=include, limit=limit, offset=offset)
\ No newline at end of file
@@ -0,0 +1,119 @@
+from ai4teaching.utils import log, count_tokens
+from ai4teaching.models.openai_client import get_openai_client
+from ai4teaching.models.rate_limiter import RateLimitScheduler, create_chat_completion
+
+class ChatHistory:
+    '''
+    Keeps the part of a conversation that is sent to the model within a token budget.
+    The most recent messages are sent verbatim. When they exceed token_budget, the older
+    ones are folded into a rolling summary. The summary is updated incrementally from the
+    previous summary and the newly folded messages, so the cost per turn stays constant
+    however long the conversation gets. The summary is limited to summary_max_tokens and
+    counts against token_budget. The full history stays in the assistant's messages.
+    '''
+    def __init__(self, openai_client=None, summary_model="gpt-3.5-turbo-1106", token_budget=3000, keep_recent_messages=4, summary_max_tokens=500):
+        if summary_max_tokens >= token_budget:
+            raise ValueError(f"summary_max_tokens ({summary_max_tokens}) has to be smaller than token_budget ({token_budget})")
+
+        # Without a client, the shared client is used
+        self.openai_client = openai_client
+        self.summary_model = summary_model
+        self.token_budget = token_budget
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_max_tokens = summary_max_tokens
+
+        self.summary_calls = 0
+        self.reset()
+
+    def reset(self):
+        self.summary = None
+        self.num_summarized_messages = 0
+        self._first_message = None
+
+    '''
+    Returns the messages to send to the model: system messages, the summary of older
+    turns (if any) and the recent turns
+    '''
+    def get_messages_for_prompt(self, messages):
+        system_messages = [m for m in messages if m["role"] == "system"]
+        conversation = [m for m in messages if m["role"] != "system"]
+
+        self._compact(conversation)
+
+        summary_messages = []
+        if self.summary is not None:
+            summary_messages.append({"role": "system", "content": f"Zusammenfassung des bisherigen Gesprächs: {self.summary}"})
+
+        return system_messages + summary_messages + conversation[self.num_summarized_messages:]
+
+    def get_stats(self):
+        return {
+            "summarized_messages" : self.num_summarized_messages,
+            "summary_tokens" : count_tokens(self.summary, self.summary_model) if self.summary is not None else 0,
+            "summary_calls" : self.summary_calls,
+            "summary_max_tokens" : self.summary_max_tokens,
+            "token_budget" : self.token_budget
+        }
+
+    def _compact(self, conversation):
+        # Start over if the assistant's messages were replaced or reset
+        first_message = conversation[0] if len(conversation) > 0 else None
+        if len(conversation) < self.num_summarized_messages or first_message is not self._first_message:
+            self.reset()
+            self._first_message = first_message
+
+        recent_messages = conversation[self.num_summarized_messages:]
+        token_counts = [count_tokens(m["content"], self.summary_model) for m in recent_messages]
+        summary_tokens = count_tokens(self.summary, self.summary_model) if self.summary is not None else 0
+        if summary_tokens + sum(token_counts) <= self.token_budget:
+            return
+
+        # The updated summary takes up to summary_max_tokens of the budget. Fold old messages
+        # until the rest fits into half of what is left, so that the summary is not updated
+        # on every turn once the budget is reached.
+        recent_token_budget = self.token_budget - self.summary_max_tokens
+        num_to_fold = 0
+        remaining_tokens = sum(token_counts)
+        while num_to_fold < len(recent_messages) - self.keep_recent_messages and remaining_tokens > recent_token_budget // 2:
+            remaining_tokens -= token_counts[num_to_fold]
+            num_to_fold += 1
+
+        if num_to_fold == 0:
+            return
+
+        self.summary = self._summarize(recent_messages[:num_to_fold])
+        self.num_summarized_messages += num_to_fold
+
+        log(f"Folded {num_to_fold} messages into the chat summary, {len(recent_messages) - num_to_fold} recent messages with {remaining_tokens} tokens are kept", type="debug")
+
+    def _summarize(self, messages_to_fold):
+        conversation = ""
+        for message in messages_to_fold:
+            conversation += f"{message['role']}: {message['content']}\n\n"
+
+        previous_summary = self.summary if self.summary is not None else "(noch keine)"
+
+        # Roughly 0.75 words per token
+        max_words = int(self.summary_max_tokens * 0.75)
+
+        summary_prompt = f"""Aktualisiere die Zusammenfassung eines Gesprächs zwischen einem Benutzer und einem Assistenten um die folgenden neuen Nachrichten. Behalte alle Fakten, Fragen und Antworten, auf die sich das weitere Gespräch beziehen könnte. Die Zusammenfassung darf höchstens {max_words} Wörter lang sein, kürze ältere Details, wenn nötig. Antworte nur mit der neuen Zusammenfassung.
+
+        Bisherige Zusammenfassung: {previous_summary}
+
+        Neue Nachrichten:
+
+        {conversation}
+        Neue Zusammenfassung: """
+
+        summary_prompt = '\n'.join([m.lstrip() for m in summary_prompt.split('\n')])
+
+        response = create_chat_completion(
+            self.openai_client if self.openai_client is not None else get_openai_client(),
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
+            model=self.summary_model,
+            messages=[{"role": "user", "content": summary_prompt}],
+            max_tokens=self.summary_max_tokens
+        )
+        self.summary_calls += 1
+
+        return response.choices[0].message.content
@@ -1,6 +1,6 @@
 from ai4teaching import Assistant
 from ai4teaching import log
-from openai import OpenAI
+from ai4teaching import RateLimitScheduler, create_chat_completion
 
 class ChatGPTAssistant(Assistant):
 
@@ -9,7 +9,6 @@ class ChatGPTAssistant(Assistant):
         log(f"ChatGPTAssistant depends on {depending_on_assistant}", type="debug") if depending_on_assistant else None
         super().__init__(config_file, depending_on_assistant)
 
-        self.openai_client = OpenAI()
         self.openai_models = [
             {"display_name" : "GPT-3.5", "model_name" : "gpt-3.5-turbo-1106"},
             {"display_name": "GPT-4", "model_name" : "gpt-4-1106-preview" }
@@ -18,6 +17,7 @@ class ChatGPTAssistant(Assistant):
         self.last_prompt = []
         self.messages = []
         self.system_message = None
+        self.chat_history = self._create_chat_history()
 
     '''
     Returns the complete message history with the assistant's response as
@@ -33,9 +33,11 @@ class ChatGPTAssistant(Assistant):
         self.messages.append(new_message_json)
 
         # Complete the prompt
-        response = self.openai_client.chat.completions.create(
+        response = create_chat_completion(
+            self.openai_client,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
             model=model_name,
-            messages=self.messages
+            messages=self.chat_history.get_messages_for_prompt(self.messages)
         )
         
         # Get the response and add to messages
@@ -45,6 +47,22 @@ class ChatGPTAssistant(Assistant):
 
         return self._get_cleaned_messages_copy()
     
+    '''
+    Streams the assistant's response and yields it token by token. The response
+    is added to the message history once the stream is complete
+    '''
+    def chat_stream(self, message, model_display_name="GPT-3.5"):
+        # Get model name for display name
+        model_name = self._get_model_name_for_display_name(model_display_name)
+
+        # Create new message entry from text and add
+        self.messages.append({"role": "user", "content": f"{message}"})
+
+        def add_assistant_message(content):
+            self.messages.append({"role": "assistant", "content": content})
+
+        yield from self._stream_chat_completion(model_name, self.chat_history.get_messages_for_prompt(self.messages), add_assistant_message)
+
     '''
     Returns only the response (last message) of the chat
     '''
@@ -58,6 +76,7 @@ class ChatGPTAssistant(Assistant):
     def reset(self):
         log("Resetting ChatGPTAssistant", type="debug")
         self.messages = []
+        self.chat_history.reset()
 
         # Add system message if present
         if self.system_message is not None:
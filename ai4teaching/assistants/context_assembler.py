@@ -0,0 +1,132 @@
+from ai4teaching.utils import log, count_tokens
+
+class ContextAssembler:
+    '''
+    Turns the result of a vector database query into the context passages for a prompt.
+    Results further away than max_distance are dropped. Chunks of the same document
+    that overlap (the end of one is the start of the other, as with overlapping
+    transcript windows or text splits) or that are adjacent in time are merged into
+    one passage, so shared text is sent only once. The passages are then packed, best
+    first, until token_budget is reached.
+    '''
+    def __init__(self, token_budget=3000, max_distance=None, min_overlap_chars=20, model_name="gpt-4-1106-preview"):
+        self.token_budget = token_budget
+        self.max_distance = max_distance
+        self.min_overlap_chars = min_overlap_chars
+        self.model_name = model_name
+
+        self.last_stats = None
+
+    '''
+    Returns a list of passages with text, chunk_ids, distance (of the best chunk) and metadata.
+    The query result has the structure of VectorDB.query() for a single query.
+    '''
+    def assemble(self, query_result):
+        ids = query_result["ids"][0]
+        distances = query_result["distances"][0] if query_result.get("distances") is not None else [0.0] * len(ids)
+        documents = query_result["documents"][0]
+        metadatas = query_result["metadatas"][0] if query_result.get("metadatas") is not None else [{}] * len(ids)
+
+        tokens_retrieved = sum(count_tokens(document, self.model_name) for document in documents)
+
+        passages = []
+        for chunk_id, distance, document, metadata in zip(ids, distances, documents, metadatas):
+            if self.max_distance is not None and distance > self.max_distance:
+                continue
+            passages.append({ "text" : document, "chunk_ids" : [chunk_id], "distance" : distance, "metadata" : dict(metadata or {}) })
+        num_filtered = len(ids) - len(passages)
+
+        passages = self._merge_passages(passages)
+        passages = self._pack_passages(passages)
+
+        tokens_used = sum(passage["tokens"] for passage in passages)
+        self.last_stats = {
+            "retrieved_chunks" : len(ids),
+            "filtered_chunks" : num_filtered,
+            "passages" : len(passages),
+            "tokens_retrieved" : tokens_retrieved,
+            "tokens_used" : tokens_used,
+            "tokens_saved" : tokens_retrieved - tokens_used
+        }
+        log(f"Assembled context from {len(ids)} chunks into {len(passages)} passages with {tokens_used} tokens ({tokens_retrieved - tokens_used} tokens saved)", type="debug")
+
+        return passages
+
+    def get_last_stats(self):
+        return self.last_stats
+
+    def _merge_passages(self, passages):
+        # Merge within each document, in the order the chunks appear in the document
+        passages_for_document = {}
+        for passage in passages:
+            passages_for_document.setdefault(self._get_document_id(passage["chunk_ids"][0]), []).append(passage)
+
+        merged_passages = []
+        for document_passages in passages_for_document.values():
+            document_passages = sorted(document_passages, key=lambda p: p["metadata"].get("start", 0))
+
+            merged = [document_passages[0]]
+            for passage in document_passages[1:]:
+                merged_text = self._merge_texts(merged[-1], passage)
+                if merged_text is None:
+                    merged.append(passage)
+                    continue
+
+                previous = merged[-1]
+                previous["text"] = merged_text
+                previous["chunk_ids"] += passage["chunk_ids"]
+                previous["distance"] = min(previous["distance"], passage["distance"])
+                if "end" in passage["metadata"]:
+                    previous["metadata"]["end"] = max(previous["metadata"].get("end", 0), passage["metadata"]["end"])
+
+            merged_passages += merged
+
+        return merged_passages
+
+    '''
+    Returns the merged text of two passages of the same document or None if they do not overlap
+    '''
+    def _merge_texts(self, first, second):
+        first_text = first["text"]
+        second_text = second["text"]
+
+        # One passage contains the other
+        if second_text in first_text:
+            return first_text
+        if first_text in second_text:
+            return second_text
+
+        # The end of the first passage is the start of the second one
+        probe = second_text[:self.min_overlap_chars]
+        if len(probe) == self.min_overlap_chars:
+            position = first_text.find(probe)
+            while position >= 0:
+                if second_text.startswith(first_text[position:]):
+                    return first_text + second_text[len(first_text) - position:]
+                position = first_text.find(probe, position + 1)
+
+        # Transcript windows that touch in time
+        if "end" in first["metadata"] and "start" in second["metadata"] and second["metadata"]["start"] <= first["metadata"]["end"]:
+            return first_text + " " + second_text
+
+        return None
+
+    def _pack_passages(self, passages):
+        packed_passages = []
+        remaining_tokens = self.token_budget
+        for passage in sorted(passages, key=lambda p: p["distance"]):
+            passage["tokens"] = count_tokens(passage["text"], self.model_name)
+
+            # Skip passages that do not fit, a later (smaller) one may still fit
+            if self.token_budget is not None and passage["tokens"] > remaining_tokens:
+                continue
+
+            packed_passages.append(passage)
+            if self.token_budget is not None:
+                remaining_tokens -= passage["tokens"]
+
+        return packed_passages
+
+    def _get_document_id(self, chunk_id):
+        # Chunk ids start with the document id, the same way the knowledge base reads them
+        return chunk_id.split("_")[0]
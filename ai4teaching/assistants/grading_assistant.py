@@ -1,8 +1,13 @@
 from ai4teaching import Assistant
 from ai4teaching import log
-from openai import OpenAI
+from ai4teaching import RateLimitScheduler, create_chat_completion
+from ai4teaching import GradingCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import os
 import json
+import threading
+import time
 
 class GradingAssistant(Assistant):
     def __init__(self, config_file, depending_on_assistant=None):
@@ -11,14 +16,19 @@ class GradingAssistant(Assistant):
         super().__init__(config_file, depending_on_assistant)
 
         self.exercises_file = os.path.join(self.root_path,"exercises.json")
-
-        self.openai_client = OpenAI()
+        self._exercises = None
+        self._exercises_fingerprint = None
 
         self._check_if_expected_properties_exist_in_config(["openai_model"])
         self.openai_model = self.config["openai_model"] if "openai_model" in self.config else "gpt-4-1106-preview"
         
+        self.grading_cache = self._create_grading_cache()
+
         self.last_prompt = []
 
+    def _create_grading_cache(self):
+        return self._create_cache("grading_cache", GradingCache, "grading_cache.sqlite", 100000)
+
     def add_exercise(self, title, instructions, model_solution, criteria=None, grading_function_schema=None, template_exercise=None, overwrite=True):
         log(f"Adding exercise to GradingAssistant: >{title}<", type="debug")
         
@@ -63,11 +73,17 @@ class GradingAssistant(Assistant):
             with open(self.exercises_file, "w", encoding="utf-8") as json_file:
                 json.dump(exercises, json_file, indent=4, ensure_ascii=False)
 
-        # Load the exercises file
-        with open(self.exercises_file, encoding="utf-8") as json_file:
-            exercises = json.load(json_file)
+        # The parsed exercises are kept in memory until the file changes
+        stat = os.stat(self.exercises_file)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if self._exercises_fingerprint != fingerprint:
+            # Load the exercises file
+            with open(self.exercises_file, encoding="utf-8") as json_file:
+                self._exercises = json.load(json_file)
+            self._exercises_fingerprint = fingerprint
 
-        return exercises
+        # Callers may change the returned list
+        return list(self._exercises)
 
     def get_exercise_by_title(self, title):
         exercises = self.get_exercises()
@@ -82,17 +98,105 @@ class GradingAssistant(Assistant):
     def grade_solution(self, exercise_title, student_solution):
         log(f"Grading solution for exercise >{exercise_title}< using >{self.openai_model}<", type="debug")
 
+        exercise = self._find_exercise(exercise_title)
+        if exercise is None:
+            return
+
+        system_prompt, grading_function_schema, exercise_hash = self._prepare_grading(exercise)
+        return self._grade_prepared_solution(exercise_title, system_prompt, grading_function_schema, exercise_hash, student_solution, RateLimitScheduler.PRIORITY_INTERACTIVE)
+
+    '''
+    Grades many solutions for one exercise and returns the feedback for each submission
+    in the order of the submissions (None if grading failed). Solutions that only differ
+    in whitespace are graded once. Up to max_concurrency solutions are graded at the same
+    time, and with requests_per_minute the requests are spaced out evenly. With an output_file, each finished grading is appended to a JSONL file right away,
+    and gradings already in that file (for the same exercise and model) are not repeated,
+    so an interrupted run can be resumed by calling this again.
+    '''
+    def grade_solutions(self, exercise_title, submissions, max_concurrency=8, requests_per_minute=None, output_file=None):
+        start = time.perf_counter()
+
+        exercise = self._find_exercise(exercise_title)
+        if exercise is None:
+            return
+
+        system_prompt, grading_function_schema, exercise_hash = self._prepare_grading(exercise)
+
+        # Collapse submissions that only differ in whitespace
+        submission_indices_for_hash = {}
+        solution_for_hash = {}
+        for i, student_solution in enumerate(submissions):
+            solution_hash = GradingCache.hash_solution(student_solution)
+            submission_indices_for_hash.setdefault(solution_hash, []).append(i)
+            solution_for_hash.setdefault(solution_hash, student_solution)
+
+        # Gradings from a previous, interrupted run
+        feedback_for_hash = {}
+        if output_file is not None:
+            feedback_for_hash = self._load_graded_solutions(output_file, exercise_hash)
+            feedback_for_hash = { h : f for h, f in feedback_for_hash.items() if h in solution_for_hash }
+
+        pending_hashes = [h for h in solution_for_hash if h not in feedback_for_hash]
+        log(f"Grading {len(submissions)} submissions for exercise >{exercise_title}<: {len(solution_for_hash)} unique, {len(feedback_for_hash)} already graded, {len(pending_hashes)} to grade", type="info")
+
+        output_lock = threading.Lock()
+        rate_lock = threading.Lock()
+        next_request_time = [time.monotonic()]
+        output = open(output_file, "a", encoding="utf-8") if output_file is not None else None
+
+        def grade(solution_hash):
+            if requests_per_minute is not None:
+                # Reserve the next free request slot and wait for it
+                with rate_lock:
+                    request_time = max(next_request_time[0], time.monotonic())
+                    next_request_time[0] = request_time + 60.0 / requests_per_minute
+                time.sleep(max(0.0, request_time - time.monotonic()))
+
+            feedback = self._grade_prepared_solution(exercise_title, system_prompt, grading_function_schema, exercise_hash, solution_for_hash[solution_hash], RateLimitScheduler.PRIORITY_BATCH)
+            if output is not None:
+                record = { "exercise_hash" : exercise_hash, "model_name" : self.openai_model, "solution_hash" : solution_hash, "feedback" : feedback }
+                with output_lock:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+            return feedback
+
+        num_failed = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+                futures = { executor.submit(grade, solution_hash) : solution_hash for solution_hash in pending_hashes }
+                for future in as_completed(futures):
+                    try:
+                        feedback_for_hash[futures[future]] = future.result()
+                    except Exception as e:
+                        # Failed gradings are not written, they are repeated on the next run
+                        num_failed += 1
+                        log(f"Grading a solution for exercise >{exercise_title}< failed: {e}", type="error")
+        finally:
+            if output is not None:
+                output.close()
+
+        results = [None] * len(submissions)
+        for solution_hash, indices in submission_indices_for_hash.items():
+            for i in indices:
+                results[i] = feedback_for_hash.get(solution_hash)
+
+        log(f"Graded {len(pending_hashes) - num_failed} solutions in {time.perf_counter() - start:.1f} s ({num_failed} failed)", type="success" if num_failed == 0 else "warning")
+
+        return results
+
+    def _find_exercise(self, exercise_title):
         exercises = self.get_exercises()
 
         # Check if an exercise with the same title already exists
         for exercise in exercises:
             if exercise["title"] == exercise_title:
                 log(f"Exercise with title >{exercise_title}< found.", type="debug")
-                break
-        else:
-            log(f"Exercise with title >{exercise_title}< not found.", type="error")
-            return
+                return exercise
 
+        log(f"Exercise with title >{exercise_title}< not found.", type="error")
+        return None
+
+    def _prepare_grading(self, exercise):
         exercise_instructions = exercise["instructions"]
         grading_criteria = exercise["grading_criteria"]
         model_solution = exercise["model_solution"]
@@ -102,12 +206,24 @@ class GradingAssistant(Assistant):
 
         #log(system_prompt, type="debug")
 
+        return system_prompt, grading_function_schema, self._hash_exercise(system_prompt, grading_function_schema)
+
+    def _grade_prepared_solution(self, exercise_title, system_prompt, grading_function_schema, exercise_hash, student_solution, priority):
+        # Identical (up to whitespace) solutions for an unchanged exercise are graded only once
+        if self.grading_cache is not None:
+            cached_feedback = self.grading_cache.get(exercise_hash, self.openai_model, student_solution)
+            if cached_feedback is not None:
+                log(f"Using cached grading for exercise >{exercise_title}<", type="debug")
+                return cached_feedback
+
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"Hier ist meine Lösung für Aufgabe. Kannst du sie bitte bewerten und mir Feedback geben?:\n\n ```\n{student_solution}\n```"}
         ]
 
-        chat_response = self.openai_client.chat.completions.create(
+        chat_response = create_chat_completion(
+            self.openai_client,
+            priority=priority,
             model=self.openai_model,
             #temperature=0,
             seed=42,
@@ -120,10 +236,42 @@ class GradingAssistant(Assistant):
 
         feedback_string = chat_response.choices[0].message.tool_calls[0].function.arguments
         feedback_json = json.loads(feedback_string)
+
+        if self.grading_cache is not None:
+            self.grading_cache.put(exercise_hash, self.openai_model, student_solution, feedback_json)
+
         return feedback_json
+
+    def _load_graded_solutions(self, output_file, exercise_hash):
+        feedback_for_hash = {}
+        if not os.path.isfile(output_file):
+            return feedback_for_hash
+
+        with open(output_file, encoding="utf-8") as jsonl_file:
+            for line in jsonl_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be incomplete if the previous run was killed
+                    continue
+
+                if record["exercise_hash"] == exercise_hash and record["model_name"] == self.openai_model:
+                    feedback_for_hash[record["solution_hash"]] = record["feedback"]
+
+        return feedback_for_hash
     
     def get_last_prompt(self):
         return self.last_prompt
+
+    def get_grading_cache_stats(self):
+        if self.grading_cache is None:
+            return None
+        return self.grading_cache.get_stats()
+
+    def _hash_exercise(self, system_prompt, grading_function_schema):
+        # The system prompt contains the instructions, the model solution and the criteria
+        exercise_json = json.dumps([system_prompt, grading_function_schema], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(exercise_json.encode("utf-8")).hexdigest()
     
     def _create_system_prompt(self, exercise_instructions, model_solution, grading_criteria):
         system_prompt = f"""Du bist ein Dozent für die Einführung in die Programmierung mit Python. Deine Aufgabe ist es, Lösungen von Studierenden zu prüfen und anschließend Feedback, Hinweise zur Verbesserung des Codes, sowie eine Punktzahl für jedes Bewertungskriterium zurückmelden. Um ein angemessenes Feedback, Hinweise und Punktzahlen zu geben, gebe ich dir die Aufgabenstellung für die Übung zusammen mit einem Beispiel für eine sehr gute Lösung, die bei allen Bewertungskriterien eine perfekte Punktzahl erhalten würde. Bewerte die Lösung der Schülerinnen und Schüler anhand der folgenden Kriterien und vergib jeweils eine Punktzahl zwischen 0 und 5:
@@ -0,0 +1,38 @@
+import hashlib
+import json
+from ai4teaching.utils.sqlite_lru_store import SQLiteLRUStore
+
+class GradingCache(SQLiteLRUStore):
+    '''
+    Persistent cache for grading results. Entries are keyed by a hash of everything
+    the model sees of the exercise (system prompt and grading function schema), the
+    model name and a hash of the normalised student solution. Changing the instructions,
+    the model solution, the criteria or the schema of an exercise changes its hash, so
+    stale results are never returned. When the cache grows beyond max_entries, the
+    least recently used entries are evicted.
+    '''
+    def __init__(self, path, max_entries=100000):
+        super().__init__(path, "grading_cache", max_entries=max_entries, name="grading cache")
+
+    '''
+    Returns the cached feedback or None if the solution was not graded before
+    '''
+    def get(self, exercise_hash, model_name, student_solution):
+        feedback = self.get_values([self._get_key(exercise_hash, model_name, student_solution)])[0]
+        return json.loads(feedback) if feedback is not None else None
+
+    def put(self, exercise_hash, model_name, student_solution, feedback):
+        self.put_values([(self._get_key(exercise_hash, model_name, student_solution), json.dumps(feedback, ensure_ascii=False))])
+
+    '''
+    Hashes a solution after normalising line endings, trailing whitespace and
+    surrounding blank lines. Indentation is kept, because it matters in Python.
+    '''
+    @staticmethod
+    def hash_solution(student_solution):
+        lines = student_solution.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        normalized_solution = "\n".join(line.rstrip() for line in lines).strip("\n")
+        return hashlib.sha256(normalized_solution.encode("utf-8")).hexdigest()
+
+    def _get_key(self, exercise_hash, model_name, student_solution):
+        return f"{exercise_hash}:{model_name}:{GradingCache.hash_solution(student_solution)}"
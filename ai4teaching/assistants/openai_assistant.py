@@ -1,27 +1,41 @@
 from ai4teaching import Assistant
 from ai4teaching import log
+from types import SimpleNamespace
+import asyncio
+import hashlib
+import json
 import time
 import os
-from openai import OpenAI
+from ai4teaching import get_async_openai_client
+from ai4teaching import RateLimitScheduler, get_rate_limit_scheduler, without_client_retries
 
 
 class OpenAIAssistant(Assistant):
+
+    PENDING_RUN_STATUSES = ["queued", "in_progress", "cancelling"]
+
     def __init__(self, config_file, depending_on_assistant=None):
         log("Initializing OpenAIAssistant", type="debug")
         log(f"OpenAIAssistant depends on {depending_on_assistant}", type="debug") if depending_on_assistant else None
         super().__init__(config_file, depending_on_assistant)
 
-        self.openai_client = OpenAI()
         self.openai_model = "gpt-4-1106-preview"
         #self.openai_model = "gpt-3.5-turbo-1106"
 
         self.assistant_id = self.config["openai_assistant_id"]
         self.thread = None
+
+        # Waiting for runs: poll quickly at first, then back off to max_poll_interval
+        self.initial_poll_interval = self.config.get("initial_poll_interval", 0.1)
+        self.max_poll_interval = self.config.get("max_poll_interval", 2.0)
+        self.poll_backoff_factor = 1.5
+        self.run_timeout = self.config.get("run_timeout", 120.0)
+        self.last_run_stats = None
+
         self._setup_client_and_assistant()
         self._create_and_attach_file()
 
     def _setup_client_and_assistant(self):
-        self.openai_client = OpenAI()
         self.openai_assistant = self.openai_client.beta.assistants.retrieve(
             self.assistant_id
         )
@@ -29,23 +43,35 @@ class OpenAIAssistant(Assistant):
     # TODO: Move this to the processor?
     def _create_and_attach_file(self):
         # Add large text file to assistant
-        # Get the list of files from the knowledge base
-        documents = self.get_list_of_vector_db_documents()
-
-        # Merge all text into one
-        text = ""
-        for t in documents["documents"]:
-            text += t
-
-        # Create a txt with the string as content
+        # Merge all text into one file, written page by page and hashed on the way
         file_name = os.path.join(self.root_path, "assistant_knowledge.txt")
+        content_hash = hashlib.sha256()
+        page_size = 1000
         with open(file_name, "w", encoding="utf-8") as file:
-            file.write(text)
+            offset = 0
+            while True:
+                # Get the documents from the knowledge base
+                documents = self.get_list_of_vector_db_documents(include=["documents"], limit=page_size, offset=offset)
+                for t in documents["documents"]:
+                    file.write(t)
+                    content_hash.update(t.encode("utf-8"))
+
+                if len(documents["ids"]) < page_size:
+                    break
+                offset += page_size
+        content_hash = content_hash.hexdigest()
         
         # Get the file from the assistant
         #log(f"{self.openai_assistant}")
         file_ids = self.openai_assistant.file_ids
 
+        # Nothing to do if the attached file was uploaded from the same content
+        upload_record = self._load_knowledge_upload_record()
+        if upload_record.get("content_hash") == content_hash and upload_record.get("file_id") in file_ids:
+            log(f"Knowledge file is unchanged, keeping uploaded file {upload_record['file_id']}", type="debug")
+            self.file = SimpleNamespace(id=upload_record["file_id"])
+            return
+
         # Delete the file from the assistant (should be only one file)
         if len(file_ids) > 0:
             try:
@@ -55,23 +81,46 @@ class OpenAIAssistant(Assistant):
 
         # Create a new file and upload it
         #log(f"Uploading file to OpenAI: {file_name}")
-        file = self.openai_client.files.create(file=open(file_name, "rb"), purpose="assistants")
+        with open(file_name, "rb") as file_to_upload:
+            file = self.openai_client.files.create(file=file_to_upload, purpose="assistants")
         #log(f"Uploaded file: {file}")
         self.file = file
         
         # Attach the new file to the assistant
         self.openai_client.beta.assistants.update(assistant_id=self.openai_assistant.id, file_ids=[file.id], model=self.openai_model)
+
+        self._save_knowledge_upload_record({ "content_hash" : content_hash, "file_id" : file.id })
         
         # Delete the file
         #os.remove(file_name)
 
+    def _get_knowledge_upload_record_file(self):
+        return os.path.join(self.root_path, "assistant_knowledge_upload.json")
+
+    def _load_knowledge_upload_record(self):
+        if not os.path.isfile(self._get_knowledge_upload_record_file()):
+            return {}
+
+        with open(self._get_knowledge_upload_record_file(), encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+    def _save_knowledge_upload_record(self, upload_record):
+        with open(self._get_knowledge_upload_record_file(), "w", encoding="utf-8") as json_file:
+            json.dump(upload_record, json_file, indent=4)
+
     def get_messages(self):
         messages = self.openai_client.beta.threads.messages.list(
             thread_id=self.thread.id
         )
         return messages
 
-    def send_message(self, message, user_name="Nicolas"):
+    '''
+    Sends a message and waits for the run to finish. The run status is polled with an
+    adaptive interval: quickly at first, then less often for long runs. If the run does
+    not finish within timeout seconds or cancel_event (a threading.Event) is set, the run
+    is cancelled. The status of the last run is available in self.last_run_stats
+    '''
+    def send_message(self, message, user_name="Nicolas", timeout=None, cancel_event=None):
         # Check if there is already a thread
         if self.thread is None:
             self.thread = self.openai_client.beta.threads.create()
@@ -82,32 +131,19 @@ class OpenAIAssistant(Assistant):
             content=f"{message}",
         )
 
-        run = self.openai_client.beta.threads.runs.create(
-            thread_id=self.thread.id,
-            assistant_id=self.openai_assistant.id,
-            instructions=f"Bitte spreche den Benutzer mit dem Namen {user_name} an und duze sie oder ihn. Antworte auf Deutsch. Wenn du auf Dokumente zurückgreifst, gib die Quelle an.",
+        # Starting a run is what uses the model, so it goes through the rate limits
+        scheduled_client = without_client_retries(self.openai_client)
+        run = get_rate_limit_scheduler().run(
+            lambda: scheduled_client.beta.threads.runs.create(
+                thread_id=self.thread.id,
+                assistant_id=self.openai_assistant.id,
+                instructions=self._get_run_instructions(user_name),
+            ),
+            self.openai_model,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE
         )
 
-        def check_run(run_id):
-            return self.openai_client.beta.threads.runs.retrieve(
-                thread_id=self.thread.id, run_id=run_id
-            )
-
-        time.sleep(0.1)
-        run = check_run(run.id)
-
-        log(f"Run status is {run.status}")
-
-        while run.status != "completed":
-            time.sleep(1)
-            run = check_run(run.id)
-            
-            if run.status == "failed":
-                log("Run failed", "error")
-                break
-
-            if run.status != "in_progress" and run.status != "completed":
-                log(f"Run status is {run.status}", "warning")
+        run = self._wait_for_run(run, timeout if timeout is not None else self.run_timeout, cancel_event)
     
         messages = self.openai_client.beta.threads.messages.list(
             thread_id=self.thread.id
@@ -116,6 +152,124 @@ class OpenAIAssistant(Assistant):
         formatted_messages = self._format_messages(messages)  
 
         return formatted_messages
+
+    '''
+    Async version of send_message(). Cancelling the task also cancels the run.
+    '''
+    async def asend_message(self, message, user_name="Nicolas", timeout=None):
+        client = get_async_openai_client()
+
+        # Check if there is already a thread
+        if self.thread is None:
+            self.thread = await client.beta.threads.create()
+
+        await client.beta.threads.messages.create(
+            thread_id=self.thread.id,
+            role="user",
+            content=f"{message}",
+        )
+
+        scheduled_client = without_client_retries(client)
+        run = await get_rate_limit_scheduler().arun(
+            lambda: scheduled_client.beta.threads.runs.create(
+                thread_id=self.thread.id,
+                assistant_id=self.openai_assistant.id,
+                instructions=self._get_run_instructions(user_name),
+            ),
+            self.openai_model,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE
+        )
+
+        run = await self._await_run(client, run, timeout if timeout is not None else self.run_timeout)
+
+        messages = await client.beta.threads.messages.list(
+            thread_id=self.thread.id
+        )
+
+        return self._format_messages(messages)
+
+    def _get_run_instructions(self, user_name):
+        return f"Bitte spreche den Benutzer mit dem Namen {user_name} an und duze sie oder ihn. Antworte auf Deutsch. Wenn du auf Dokumente zurückgreifst, gib die Quelle an."
+
+    def _wait_for_run(self, run, timeout, cancel_event=None):
+        start = time.monotonic()
+        poll_interval = self.initial_poll_interval
+        num_polls = 0
+
+        while run.status in OpenAIAssistant.PENDING_RUN_STATUSES:
+            if cancel_event is not None and cancel_event.is_set():
+                log(f"Cancelling run {run.id}", type="warning")
+                run = self._cancel_run(run)
+                break
+
+            remaining_time = timeout - (time.monotonic() - start)
+            if remaining_time <= 0:
+                log(f"Run {run.id} did not finish within {timeout} s, cancelling", type="error")
+                run = self._cancel_run(run)
+                break
+
+            # Waiting on the event returns early when the run is cancelled
+            if cancel_event is not None:
+                cancel_event.wait(min(poll_interval, remaining_time))
+            else:
+                time.sleep(min(poll_interval, remaining_time))
+
+            run = self.openai_client.beta.threads.runs.retrieve(thread_id=self.thread.id, run_id=run.id)
+            num_polls += 1
+            poll_interval = min(poll_interval * self.poll_backoff_factor, self.max_poll_interval)
+
+        return self._finish_run(run, num_polls, time.monotonic() - start)
+
+    async def _await_run(self, client, run, timeout):
+        start = time.monotonic()
+        poll_interval = self.initial_poll_interval
+        num_polls = 0
+
+        try:
+            while run.status in OpenAIAssistant.PENDING_RUN_STATUSES:
+                remaining_time = timeout - (time.monotonic() - start)
+                if remaining_time <= 0:
+                    log(f"Run {run.id} did not finish within {timeout} s, cancelling", type="error")
+                    run = await self._acancel_run(client, run)
+                    break
+
+                await asyncio.sleep(min(poll_interval, remaining_time))
+
+                run = await client.beta.threads.runs.retrieve(thread_id=self.thread.id, run_id=run.id)
+                num_polls += 1
+                poll_interval = min(poll_interval * self.poll_backoff_factor, self.max_poll_interval)
+        except asyncio.CancelledError:
+            # Do not leave the run going on the server
+            log(f"Cancelling run {run.id}", type="warning")
+            await asyncio.shield(self._acancel_run(client, run))
+            raise
+
+        return self._finish_run(run, num_polls, time.monotonic() - start)
+
+    def _cancel_run(self, run):
+        try:
+            return self.openai_client.beta.threads.runs.cancel(thread_id=self.thread.id, run_id=run.id)
+        except Exception as e:
+            log(f"Could not cancel run {run.id}: {e}", type="warning")
+            return run
+
+    async def _acancel_run(self, client, run):
+        try:
+            return await client.beta.threads.runs.cancel(thread_id=self.thread.id, run_id=run.id)
+        except Exception as e:
+            log(f"Could not cancel run {run.id}: {e}", type="warning")
+            return run
+
+    def _finish_run(self, run, num_polls, wait_time):
+        if run.status == "failed":
+            log("Run failed", "error")
+        elif run.status != "completed":
+            log(f"Run status is {run.status}", "warning")
+
+        self.last_run_stats = { "status" : run.status, "polls" : num_polls, "wait_time" : wait_time }
+        log(f"Run finished with status {run.status} after {wait_time:.2f} s and {num_polls} status requests", type="debug")
+
+        return run
     
     def reset(self):
         self.thread = None
@@ -1,6 +1,6 @@
 from ai4teaching import Assistant
 from ai4teaching import log
-from openai import OpenAI
+from ai4teaching import RateLimitScheduler, create_chat_completion
 import os
 import json
 import random
@@ -11,7 +11,6 @@ class QuizAssistant(Assistant):
         log(f"QuizAssistant depends on {depending_on_assistant}") if depending_on_assistant else None
         super().__init__(config_file, depending_on_assistant)
 
-        self.openai_client = OpenAI()
         self.openai_model = "gpt-4-1106-preview"
         self.question_json_file = self.config["question_json_file"] if "question_json_file" in self.config else None
 
@@ -108,7 +107,9 @@ class QuizAssistant(Assistant):
         )
         messages.append({ "role": "user", "content": f"Here is text: \"{text}\"" })
 
-        mc_question = self.openai_client.chat.completions.create(
+        mc_question = create_chat_completion(
+            self.openai_client,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
             model=self.openai_model,
             messages=messages,
             tools=[{"type": "function", "function": self._create_function_json()}],
@@ -129,7 +130,9 @@ class QuizAssistant(Assistant):
         )
         messages.append({ "role": "user", "content": f"The topic: {topic}" })
 
-        mc_question = self.openai_client.chat.completions.create(
+        mc_question = create_chat_completion(
+            self.openai_client,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
             model=self.openai_model,
             messages=messages,
             tools=[{"type": "function", "function": self._create_function_json()}],
@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
 from ai4teaching import Assistant
 from ai4teaching import log
-from openai import OpenAI
+from ai4teaching import RateLimitScheduler, create_chat_completion
+from ai4teaching import ContextAssembler
 
 class RetrievalAssistant(Assistant):
 
@@ -9,19 +12,67 @@ class RetrievalAssistant(Assistant):
         log(f"RetrievalAssistant depends on {depending_on_assistant}", type="debug") if depending_on_assistant else None
         super().__init__(config_file, depending_on_assistant)
 
-        self.openai_client = OpenAI()
         self.openai_model = "gpt-4-1106-preview"
         
         self.last_prompt = []
         self.messages = []
         self.system_message = None
+        self.chat_history = self._create_chat_history()
+
+        # Retrieval and packing of the context passages into the prompt
+        context_config = self.config.get("context", {})
+        self.n_results = context_config.get("n_results", 5)
+        self.context_assembler = ContextAssembler(
+            token_budget=context_config.get("token_budget", 3000),
+            max_distance=context_config.get("max_distance"),
+            model_name=self.openai_model
+        )
+
+        # Retrieve for the raw message while the question is condensed, and keep those
+        # results if the condensed question means (almost) the same
+        self.speculative_retrieval = context_config.get("speculative_retrieval", False)
+        self.speculative_similarity = context_config.get("speculative_similarity", 0.95)
+        self.last_retrieval_stats = None
 
     def chat(self, message, model="gpt-4-1106-preview"):
         
+        prompt = self._create_prompt_with_retrieved_documents(message)
+
+        # Complete the prompt
+        response = create_chat_completion(
+            self.openai_client,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
+            model=model,
+            messages= [ { "role": "user", "content": prompt } ]
+        )
+
+        response_message = {"role": "assistant", "content": response.choices[0].message.content}
+
+        # Add the assistants response to the messages
+        self.messages.append(response_message)
+        
+        return self._get_cleaned_messages_copy()
+
+    '''
+    Like chat(), but yields the response token by token. The response is added
+    to the message history once the stream is complete
+    '''
+    def chat_stream(self, message, model="gpt-4-1106-preview"):
+
+        prompt = self._create_prompt_with_retrieved_documents(message)
+
+        def add_assistant_message(content):
+            self.messages.append({"role": "assistant", "content": content})
+
+        yield from self._stream_chat_completion(model, [ { "role": "user", "content": prompt } ], add_assistant_message)
+
+    def _create_prompt_with_retrieved_documents(self, message):
+
         # Create new message entry from text and add
         new_message_json = {"role": "user", "content": f"{message}"}
 
-        condensed_question = self._condense_messages_for_retrieval(message, self.messages)
+        # Retrieve documents for condensed question
+        condensed_question, retrieved_documents = self._retrieve_documents_for_message(message)
 
         # Save for debug
         self.last_condensed_question = condensed_question
@@ -29,15 +80,16 @@ class RetrievalAssistant(Assistant):
         # Add the message from the user to the messages
         self.messages.append(new_message_json)
 
-        # Retrieve documents for condensed question
-        retrieved_documents = self.vector_db.query(condensed_question, n_results=5)
+        # Drop distant chunks, merge overlapping ones and stay within the token budget
+        context_passages = self.context_assembler.assemble(retrieved_documents)
 
         retrieved_documents_string = ""
-        for doc in retrieved_documents["documents"][0]:
-            retrieved_documents_string += f"\"{doc}\"\n\n"
+        for passage in context_passages:
+            retrieved_documents_string += f"\"{passage['text']}\"\n\n"
 
         # Save for debug
         self.last_retrieved_documents = retrieved_documents
+        self.last_context_passages = context_passages
         
         # Create prompt with retrieved documents
         prompt = f"""Beantworte die folgende Frage eines Bürgers ausschließlich auf Basis der folgenden Texte, die aus Dokumenten zum Food Future Lab stammen. Erfinde keine Antworten, wenn die notwendigen Informationen nicht in den Texten enthalten sind. Sag dann einfach, dass du darüber keine Informationen vorliegen hast. Leite deine Antwort mit folgenden oder ähnlichen Wörten ein: \"Basierend auf meinem Wissen...\", \"Meines Wissens nach...\", \"Soweit mir bekannt...\". Erwähne NIEMALS, dass dir Dokumente oder Textauszüge vorliegen. Vermeide also Sätze wie "in den vorligenden Dokumenten" oder "in den mir bekannten Texten..." etc.
@@ -53,19 +105,59 @@ class RetrievalAssistant(Assistant):
 
         self.last_prompt = prompt
 
-        # Complete the prompt
-        response = self.openai_client.chat.completions.create(
-            model=model,
-            messages= [ { "role": "user", "content": prompt } ]
-        )
+        return prompt
 
-        response_message = {"role": "assistant", "content": response.choices[0].message.content}
+    '''
+    Returns the condensed question and the retrieved documents for a new user message
+    '''
+    def _retrieve_documents_for_message(self, message):
+        history = self.chat_history.get_messages_for_prompt(self.messages)
+
+        # Without previous turns there is nothing to condense
+        if not any(m["role"] != "system" for m in history):
+            self.last_retrieval_stats = { "condensed" : False, "speculative" : False, "reused_speculative_results" : False }
+            return message, self.vector_db.query(message, n_results=self.n_results)
+
+        if not self.speculative_retrieval:
+            condensed_question = self._condense_messages_for_retrieval(message, history)
+            self.last_retrieval_stats = { "condensed" : True, "speculative" : False, "reused_speculative_results" : False }
+            return condensed_question, self.vector_db.query(condensed_question, n_results=self.n_results)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            condense_future = executor.submit(self._condense_messages_for_retrieval, message, history)
+            speculative_future = executor.submit(self._embed_and_query, message)
+            condensed_question = condense_future.result()
+            speculative_embedding, speculative_documents = speculative_future.result()
+
+        self.last_retrieval_stats = { "condensed" : True, "speculative" : True, "reused_speculative_results" : True, "similarity" : 1.0 }
+
+        # The condensed question is often the message itself
+        if self._normalize_question(condensed_question) == self._normalize_question(message):
+            return condensed_question, speculative_documents
+
+        condensed_embedding = self.vector_db.embedding_model.embed(condensed_question).data[0].embedding
+        similarity = self._cosine_similarity(speculative_embedding, condensed_embedding)
+        self.last_retrieval_stats["similarity"] = similarity
+
+        if similarity >= self.speculative_similarity:
+            log(f"Reusing speculative retrieval results (similarity {similarity:.3f})", type="debug")
+            return condensed_question, speculative_documents
+
+        self.last_retrieval_stats["reused_speculative_results"] = False
+        return condensed_question, self.vector_db.query_by_embeddings([condensed_embedding], n_results=self.n_results)
+
+    def _embed_and_query(self, text):
+        embedding = self.vector_db.embedding_model.embed(text).data[0].embedding
+        return embedding, self.vector_db.query_by_embeddings([embedding], n_results=self.n_results)
+
+    def _normalize_question(self, question):
+        return " ".join(question.strip().strip("\"'").lower().split())
+
+    def _cosine_similarity(self, a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm > 0 else 0.0
 
-        # Add the assistants response to the messages
-        self.messages.append(response_message)
-        
-        return self._get_cleaned_messages_copy()
-    
     def _condense_messages_for_retrieval(self, current_prompt, messages):
 
         chat_history = ""
@@ -89,7 +181,9 @@ class RetrievalAssistant(Assistant):
         condense_instruction_message = {"role": "user", "content": f"{condense_prompt}"}
         condense_messages.append(condense_instruction_message)
 
-        response = self.openai_client.chat.completions.create(
+        response = create_chat_completion(
+            self.openai_client,
+            priority=RateLimitScheduler.PRIORITY_INTERACTIVE,
             model=self.openai_model,
             messages=condense_messages
         )
@@ -120,6 +214,7 @@ class RetrievalAssistant(Assistant):
     def reset(self):
         log("Resetting RetrievalAssistant", type="debug")
         self.messages = []
+        self.chat_history.reset()
 
         # Add system message if present
         if self.system_message is not None:
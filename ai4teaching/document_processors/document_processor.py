@@ -1,5 +1,7 @@
 from ai4teaching import EmbeddingModel
-from ai4teaching.utils import log, make_sure_directory_exists
+from ai4teaching.utils import log, make_sure_directory_exists, record_usage
+import asyncio
+import hashlib
 import json
 import os
 import uuid
@@ -42,12 +44,57 @@ class DocumentProcessor:
         
         self.step_ouput_files = {}
         self.embedding_model = embedding_model
+
+        # Fingerprints of the steps that run now, recorded in the document once their output is written
+        self._pending_step_fingerprints = {}
+
+        # Results of the steps that ran in this process and content hashes of the step outputs,
+        # so that later steps do not read them back from disk
+        self._step_results = {}
+        self._step_output_hashes = {}
+
+        self.pipeline_metrics = {}
         
     def process(self):
         return self.document
+
+    '''
+    Runs the steps of a ProcessingPipeline and keeps its metrics in self.pipeline_metrics
+    '''
+    def _run_pipeline(self, pipeline):
+        try:
+            pipeline.run()
+        finally:
+            self.pipeline_metrics = pipeline.get_metrics()
+
+    async def _arun_pipeline(self, pipeline):
+        try:
+            await pipeline.arun()
+        finally:
+            self.pipeline_metrics = pipeline.get_metrics()
+
+    '''
+    Returns wall time, API calls and bytes written of each step of the last run
+    '''
+    def get_pipeline_metrics(self):
+        return self.pipeline_metrics
+
+    '''
+    Async version of process(). Subclasses override this to await their network bound
+    steps, the default runs the synchronous pipeline in a worker thread
+    '''
+    async def aprocess(self):
+        return await asyncio.to_thread(self.process)
     
     def _create_document_chunks(self, previous_step_name=None):
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, previous_step_name=previous_step_name)
+        chunk_size = 1000
+        chunk_overlap_pct = 0.1
+
+        processing_required = self._prepare_and_check_if_processing_step_required(
+            DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, 
+            previous_step_name=previous_step_name,
+            parameters={ "chunk_size" : chunk_size, "chunk_overlap_pct" : chunk_overlap_pct }
+        )
         
         if not processing_required:
             return
@@ -55,9 +102,6 @@ class DocumentProcessor:
         # Read the result from the previous step
         previous_step_result = self._load_json_file_for_step(previous_step_name)
 
-        chunk_size = 1000
-        chunk_overlap_pct = 0.1
-
         text_splitter = CharacterTextSplitter(
             separator = "\n\n",
             chunk_size = chunk_size,
@@ -79,9 +123,10 @@ class DocumentProcessor:
             "chunks" : [] 
                         }
         
-        for i, split in enumerate(splits):
+        seen_chunk_ids = set()
+        for split in splits:
             chunk = { 
-                "chunk_id" : f"{chunks_document['id']}_{i}",
+                "chunk_id" : self._create_chunk_id(split.page_content, seen_chunk_ids),
                 "metadata" : split.metadata,
                 "content" : split.page_content
             }
@@ -92,13 +137,40 @@ class DocumentProcessor:
         
     def _embed_document_chunks(self, previous_step_name=None):
 
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, previous_step_name=previous_step_name)
+        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, previous_step_name=previous_step_name, parameters={ "embedding_model" : self.embedding_model.model_name })
 
         if not processing_required:
             return
-    
-        # Load chunks file
-        chunks_document = self._load_json_file_for_step(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+
+        chunks_document, pending_chunks, checkpoint_batch = self._prepare_embedding_of_document_chunks()
+
+        docs = [chunk["content"] for chunk in pending_chunks]
+        self.embedding_model.embed_in_batches(docs, on_batch_embedded=checkpoint_batch)
+
+        self._finish_embedding_of_document_chunks(chunks_document)
+
+    async def _aembed_document_chunks(self, previous_step_name=None):
+
+        processing_required = await asyncio.to_thread(self._prepare_and_check_if_processing_step_required, DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, previous_step_name=previous_step_name, parameters={ "embedding_model" : self.embedding_model.model_name })
+
+        if not processing_required:
+            return
+
+        chunks_document, pending_chunks, checkpoint_batch = await asyncio.to_thread(self._prepare_embedding_of_document_chunks)
+
+        docs = [chunk["content"] for chunk in pending_chunks]
+        await self.embedding_model.aembed_in_batches(docs, on_batch_embedded=checkpoint_batch)
+
+        await asyncio.to_thread(self._finish_embedding_of_document_chunks, chunks_document)
+
+    '''
+    Loads the chunks and the checkpoint of a previous run. Returns the chunks document,
+    the chunks that still need an embedding and a callback that checkpoints finished batches
+    '''
+    def _prepare_embedding_of_document_chunks(self):
+        # Load chunks file, the copy leaves the chunks step's result unchanged for other steps
+        chunks_document = dict(self._load_json_file_for_step(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS))
+        chunks_document["chunks"] = [dict(chunk) for chunk in chunks_document["chunks"]]
 
         # Initialize summary JSON with mandatory fields
         embbeded_chunks_document = self._get_mandatory_document_data()
@@ -106,17 +178,64 @@ class DocumentProcessor:
         # Add additional fields into existing JSON
         embbeded_chunks_document["chunks"] = chunks_document["chunks"]
 
-        docs = [chunk["content"] for chunk in embbeded_chunks_document["chunks"]]
-        embeds = self.embedding_model.embed(docs)
-
-        # Add embeddings to chunks
-        for i, chunk in enumerate(embbeded_chunks_document["chunks"]):
-            chunk["embedding"] = embeds.data[i].embedding
+        # Reuse embeddings of unchanged chunk texts from the previous output and from batches
+        # that were finished in a previous (interrupted) run, so only new texts are embedded
+        model_name = self.embedding_model.model_name
+        chunks_document["embedding_model"] = model_name
+        known_embeddings = self._load_previous_embeddings(model_name)
+        known_embeddings.update({ record["content_hash"] : record["embedding"] for record in self._load_step_checkpoint(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS) if record.get("model_name") == model_name })
         
+        pending_chunks = []
+        for chunk in embbeded_chunks_document["chunks"]:
+            content_hash = self._hash_text(chunk["content"])
+            if content_hash in known_embeddings:
+                chunk["embedding"] = known_embeddings[content_hash]
+            else:
+                pending_chunks.append(chunk)
+
+        num_reused = len(embbeded_chunks_document["chunks"]) - len(pending_chunks)
+        if num_reused > 0:
+            log(f"Reusing {num_reused} embeddings for >{self.document['title']}<, {len(pending_chunks)} of {len(embbeded_chunks_document['chunks'])} chunks left to embed", type="info")
+
+        def checkpoint_batch(indices, embeddings):
+            records = []
+            for i, embedding in zip(indices, embeddings):
+                pending_chunks[i]["embedding"] = embedding
+                records.append({ "content_hash" : self._hash_text(pending_chunks[i]["content"]), "model_name" : model_name, "embedding" : embedding })
+            self._append_to_step_checkpoint(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, records)
+
+        return chunks_document, pending_chunks, checkpoint_batch
+
+    def _load_previous_embeddings(self, model_name):
+        previous_output_file_name = self.step_ouput_files[DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS]
+        if not os.path.isfile(previous_output_file_name):
+            return {}
+
+        with open(previous_output_file_name, "r", encoding="utf-8") as json_file:
+            previous_output = json.load(json_file)
+
+        # Embeddings of another model can not be mixed with new ones
+        if previous_output.get("embedding_model") != model_name:
+            return {}
+
+        return { self._hash_text(chunk["content"]) : chunk["embedding"] for chunk in previous_output["chunks"] if "embedding" in chunk }
+
+    def _finish_embedding_of_document_chunks(self, chunks_document):
         # Write to file
         self._save_json_file_for_step(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, chunks_document)
-
-    def _prepare_and_check_if_processing_step_required(self, step_name, previous_step_output_created_date=None, previous_step_name=None):
+        self._remove_step_checkpoint(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS)
+
+    '''
+    Decides whether a step has to run. Each step records a fingerprint of its inputs in
+    document["processing_fingerprints"]: the content hash of the previous step's output, the
+    external inputs (such as the hash of the source file) and the parameters (such as the
+    chunk size or the model name). The step runs again only if its output is missing or the
+    fingerprint changed, so touching a file or moving the output directory does not trigger
+    it. Outputs without a recorded fingerprint (from before fingerprints were recorded) are
+    checked by modification time once and then get their fingerprint.
+    An input of None means it could not be determined, the existing output is kept then.
+    '''
+    def _prepare_and_check_if_processing_step_required(self, step_name, previous_step_output_created_date=None, previous_step_name=None, inputs=None, parameters=None):
         
         # Create directory for the result of this step if not exists
         directory = os.path.join(self.processed_documents_path, step_name)
@@ -128,10 +247,26 @@ class DocumentProcessor:
         # Set the out file name for the step
         self.step_ouput_files[step_name] = file_name
 
+        fingerprint = self._create_step_fingerprint(step_name, previous_step_name, inputs, parameters)
+        self._pending_step_fingerprints[step_name] = fingerprint
+
         # Check if file exists
         if not os.path.isfile(file_name):
             log(f"Processing step >{step_name}< is required.", type="debug")
             return True
+
+        if fingerprint is None:
+            log(f"Inputs of processing step >{step_name}< could not be determined, keeping the existing output", type="warning")
+            return False
+
+        recorded_fingerprint = self.document.get("processing_fingerprints", {}).get(step_name)
+        if recorded_fingerprint is not None:
+            if recorded_fingerprint != fingerprint:
+                log(f"Processing step >{step_name}< is required, its inputs or parameters changed.", type="debug")
+                return True
+
+            log(f"Processing step >{step_name}< is not required.", type="debug")
+            return False
         
         # If previous step output created time is not None, check if the previous step is newer than the current step
         if previous_step_output_created_date is not None:
@@ -146,7 +281,7 @@ class DocumentProcessor:
         
         # Check if the outfile's create date of the previous step is newer than the result of this step
         if previous_step_name is not None:
-            previous_processing_output_file_name = self.document["processing_outputs"][previous_step_name]
+            previous_processing_output_file_name = self.step_ouput_files[previous_step_name]
            
             # Get the create date of the previous step
             previous_processing_output_file_create_date = os.path.getmtime(previous_processing_output_file_name)
@@ -159,13 +294,80 @@ class DocumentProcessor:
                 log(f"Processing step >{step_name}< is required.", type="debug")
                 return True
 
+        # The existing output is up to date, from now on it is checked by its fingerprint
+        self._record_step_fingerprint(step_name)
         log(f"Processing step >{step_name}< is not required.", type="debug")
+        return False
+
+    def _create_step_fingerprint(self, step_name, previous_step_name=None, inputs=None, parameters=None):
+        inputs = dict(inputs or {})
+        if previous_step_name is not None:
+            inputs[previous_step_name] = self._get_step_output_hash(previous_step_name)
+
+        if any(value is None for value in inputs.values()):
+            return None
+
+        fingerprint = { "step" : step_name, "inputs" : inputs, "parameters" : parameters or {} }
+        return self._hash_text(json.dumps(fingerprint, sort_keys=True))
+
+    '''
+    Records the fingerprint of a step in the document, called once the step's output is written
+    '''
+    def _record_step_fingerprint(self, step_name):
+        fingerprint = self._pending_step_fingerprints.pop(step_name, None)
+        if fingerprint is not None:
+            self.document.setdefault("processing_fingerprints", {})[step_name] = fingerprint
+
+    def _get_step_output_hash(self, step_name):
+        if step_name not in self._step_output_hashes:
+            self._step_output_hashes[step_name] = self._hash_file(self.step_ouput_files[step_name])
+        return self._step_output_hashes[step_name]
+
+    '''
+    Returns the SHA-256 hash of a file. The hash is kept with the file's size and modification
+    time in document["processing_file_hashes"], so a file is only read again when it changed.
+    '''
+    def _hash_file(self, file_name):
+        if not os.path.isfile(file_name):
+            return None
+
+        stat = os.stat(file_name)
+        file_hashes = self.document.setdefault("processing_file_hashes", {})
+        recorded = file_hashes.get(file_name)
+        if recorded is not None and recorded["size"] == stat.st_size and recorded["mtime_ns"] == stat.st_mtime_ns:
+            return recorded["hash"]
+
+        file_hash = hashlib.sha256()
+        with open(file_name, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                file_hash.update(block)
+
+        self._record_file_hash(file_name, file_hash.hexdigest(), stat)
+        return file_hash.hexdigest()
+
+    def _record_file_hash(self, file_name, file_hash, stat=None):
+        stat = stat if stat is not None else os.stat(file_name)
+        self.document.setdefault("processing_file_hashes", {})[file_name] = { "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "hash" : file_hash }
     
+    '''
+    Writes the result of a step to disk and keeps it in memory for the following steps.
+    Steps must not change the results they load, as they are shared.
+    '''
     def _save_json_file_for_step(self, step_name, json_object):
-        with open(f"{self.step_ouput_files[step_name]}", "w", encoding="utf-8") as json_file:
-            json.dump(json_object, json_file, indent=4, ensure_ascii=False)
+        data = json.dumps(json_object, indent=4, ensure_ascii=False).encode("utf-8")
+        with open(f"{self.step_ouput_files[step_name]}", "wb") as json_file:
+            json_file.write(data)
+        record_usage(bytes_written=len(data))
+
+        self._step_results[step_name] = json_object
+        self._step_output_hashes[step_name] = hashlib.sha256(data).hexdigest()
+        self._record_file_hash(self.step_ouput_files[step_name], self._step_output_hashes[step_name])
+        self._record_step_fingerprint(step_name)
 
     def _load_json_file_for_step(self, step_name):
+        if step_name in self._step_results:
+            return self._step_results[step_name]
+
         with open(self.step_ouput_files[step_name], "r", encoding="utf-8") as json_file:
             file_json = json.load(json_file)
             
@@ -176,6 +378,67 @@ class DocumentProcessor:
     
         return file_json
 
+    '''
+    Checkpoints are JSON lines files next to the step output that collect the results
+    of finished work items, so that an interrupted step can continue where it stopped
+    '''
+    def _get_checkpoint_file_name(self, step_name):
+        return f"{self.step_ouput_files[step_name]}.checkpoint.jsonl"
+
+    def _load_step_checkpoint(self, step_name):
+        checkpoint_file_name = self._get_checkpoint_file_name(step_name)
+        if not os.path.isfile(checkpoint_file_name):
+            return []
+
+        records = []
+        incomplete = False
+        with open(checkpoint_file_name, "r", encoding="utf-8") as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The last line may be incomplete if the process was killed while writing
+                    log(f"Skipping incomplete line in checkpoint >{checkpoint_file_name}<", type="warning")
+                    incomplete = True
+
+        # Rewrite the checkpoint without the incomplete line, so that new records can be appended
+        if incomplete:
+            os.remove(checkpoint_file_name)
+            self._append_to_step_checkpoint(step_name, records)
+
+        return records
+
+    def _append_to_step_checkpoint(self, step_name, records):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        with open(self._get_checkpoint_file_name(step_name), "ab") as checkpoint_file:
+            checkpoint_file.write(data)
+            checkpoint_file.flush()
+        record_usage(bytes_written=len(data))
+
+    def _remove_step_checkpoint(self, step_name):
+        checkpoint_file_name = self._get_checkpoint_file_name(step_name)
+        if os.path.isfile(checkpoint_file_name):
+            os.remove(checkpoint_file_name)
+
+    '''
+    Chunk ids are derived from the chunk content, so that unchanged chunks keep their id
+    when a document is re-processed. Identical texts within a document get a counter suffix.
+    '''
+    def _create_chunk_id(self, content, seen_chunk_ids):
+        chunk_id = f"{self.document['id']}_{self._hash_text(content)[:16]}"
+        
+        unique_chunk_id = chunk_id
+        occurrence = 1
+        while unique_chunk_id in seen_chunk_ids:
+            occurrence += 1
+            unique_chunk_id = f"{chunk_id}_{occurrence}"
+
+        seen_chunk_ids.add(unique_chunk_id)
+        return unique_chunk_id
+
+    def _hash_text(self, text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
     def _get_mandatory_document_data(self):
 
         # Make sure required fields are present
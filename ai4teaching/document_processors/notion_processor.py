@@ -1,8 +1,11 @@
 from ai4teaching import DocumentProcessor
+from ai4teaching import ProcessingPipeline
 from ai4teaching import EmbeddingModel
-from ai4teaching.utils import log
+from ai4teaching.utils import log, record_usage
 from datetime import datetime
 import requests
+import asyncio
+import functools
 
 class NotionProcessor(DocumentProcessor):
     def __init__(self, document, processed_documents_path, embedding_model: EmbeddingModel):
@@ -20,23 +23,60 @@ class NotionProcessor(DocumentProcessor):
     def process(self):
         log(f"Processing notion pages from >{self.document['document_uri']}<", type="info")
 
-        self._fetch_content_from_notion_api()
+        self._run_pipeline(self._create_pipeline())
 
-        self._merge_notion_blocks()
+        self.document["processing_outputs"] = self.step_ouput_files
 
-        self._create_document_chunks(DocumentProcessor.STEP_MERGE_NOTION_BLOCKS)
+        log(f"✔ Done processing notion pages from >{self.document['document_uri']}<", type="success")
+        return self.document
 
-        self._embed_document_chunks(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+    async def aprocess(self):
+        log(f"Processing notion pages from >{self.document['document_uri']}<", type="info")
+
+        await self._arun_pipeline(self._create_pipeline())
 
         self.document["processing_outputs"] = self.step_ouput_files
 
         log(f"✔ Done processing notion pages from >{self.document['document_uri']}<", type="success")
         return self.document
 
+    def _create_pipeline(self):
+        pipeline = ProcessingPipeline(self.document["title"])
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API, 
+            self._fetch_content_from_notion_api, 
+            async_function=self._afetch_content_from_notion_api
+        )
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_MERGE_NOTION_BLOCKS, 
+            self._merge_notion_blocks, 
+            inputs=[DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API]
+        )
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, 
+            functools.partial(self._create_document_chunks, DocumentProcessor.STEP_MERGE_NOTION_BLOCKS), 
+            inputs=[DocumentProcessor.STEP_MERGE_NOTION_BLOCKS]
+        )
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, 
+            functools.partial(self._embed_document_chunks, DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS), 
+            inputs=[DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS],
+            async_function=functools.partial(self._aembed_document_chunks, DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        )
+
+        return pipeline
+
     def _fetch_content_from_notion_api(self):
+        last_edited_time = self._get_last_edited_time(self.document["notion_page_block_id"])
+
         processing_required = self._prepare_and_check_if_processing_step_required(
             DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API, 
-            previous_step_output_created_date=self._get_last_edited_time(self.document["notion_page_block_id"])
+            previous_step_output_created_date=last_edited_time,
+            inputs={ "notion_last_edited_time" : last_edited_time }
         )
 
         if not processing_required:
@@ -55,6 +95,34 @@ class NotionProcessor(DocumentProcessor):
         # Save output to file
         self._save_json_file_for_step(DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API, notion_document)
     
+    async def _afetch_content_from_notion_api(self):
+        import httpx
+        async with httpx.AsyncClient(headers=self._get_notion_headers()) as http_client:
+            last_edited_time = await self._aget_last_edited_time(http_client, self.document["notion_page_block_id"])
+
+            processing_required = await asyncio.to_thread(
+                self._prepare_and_check_if_processing_step_required,
+                DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API, 
+                previous_step_output_created_date=last_edited_time,
+                inputs={ "notion_last_edited_time" : last_edited_time }
+            )
+
+            if not processing_required:
+                return
+
+            # Initialize summary JSON with mandatory fields
+            notion_document = self._get_mandatory_document_data()
+
+            # Add additional fields to exsitng JSON
+            notion_document["metadata"]["notion_page_block_id"] = self.document["notion_page_block_id"]
+
+            # Get and add text blocks from Notion document
+            notion_text_blocks = await self._aget_text_blocks_by_notion_page_id(http_client, self.document["notion_page_block_id"])
+            notion_document["content"] = notion_text_blocks
+
+        # Save output to file
+        await asyncio.to_thread(self._save_json_file_for_step, DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API, notion_document)
+
     def _merge_notion_blocks(self):
         processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_MERGE_NOTION_BLOCKS, previous_step_name=DocumentProcessor.STEP_FETCH_CONTENT_FROM_NOTION_API)
 
@@ -92,6 +160,7 @@ class NotionProcessor(DocumentProcessor):
         }
 
         response = requests.get(url, headers=headers)
+        record_usage(api_calls=1)
 
         if response.status_code == 200:
             resp_json = response.json()
@@ -99,8 +168,22 @@ class NotionProcessor(DocumentProcessor):
             timestamp = last_edited_time.timestamp()
             return timestamp
         else:
-            print(f"Request failed with status code {response.status_code}: {response.text}")
-            return "ERROR"
+            # None tells the processing step that the page version is unknown
+            log(f"Request for last edited time of Notion page >{block_id}< failed with status code {response.status_code}: {response.text}", type="error")
+            return None
+
+    async def _aget_last_edited_time(self, http_client, block_id):
+        response = await http_client.get(f'https://api.notion.com/v1/pages/{block_id}')
+        record_usage(api_calls=1)
+
+        if response.status_code == 200:
+            resp_json = response.json()
+            last_edited_time = datetime.fromisoformat(resp_json["last_edited_time"])
+            timestamp = last_edited_time.timestamp()
+            return timestamp
+        else:
+            log(f"Request for last edited time of Notion page >{block_id}< failed with status code {response.status_code}: {response.text}", type="error")
+            return None
 
     def _get_title_by_notion_page_id(self, block_id):
         url = f'https://api.notion.com/v1/pages/{block_id}'
@@ -111,6 +194,7 @@ class NotionProcessor(DocumentProcessor):
         }
 
         response = requests.get(url, headers=headers)
+        record_usage(api_calls=1)
 
         if response.status_code == 200:
             resp_json = response.json()
@@ -130,29 +214,46 @@ class NotionProcessor(DocumentProcessor):
         }
 
         response = requests.get(url, headers=headers)
+        record_usage(api_calls=1)
 
-        notion_text_blocks = []
         if response.status_code == 200:
             # You can access the response content using response.text or response.json()
-            resp_json = response.json()
-            for block in resp_json["results"]:
-
-                #print(f"Processing block of type >{block['type']}<")
-                #print(block)
-
-                # TODO: Do we need other block types?
-                if block["type"] in ["paragraph", "bulleted_list_item", "numbered_list_item", "heading_1", "heading_2", "heading_3"]:
-                    plain = ""
-
-                    print(block["type"])
-                    for rt in block[block["type"]]["rich_text"]:
-                        plain += rt["plain_text"]         
-                    
-                    prefixes = { "paragraph" : "", "bulleted_list_item" : "- ", "numbered_list_item" : "- ", "heading_1" : "# ", "heading_2" : "## ", "heading_3" : "### " }
-                    notion_text_blocks.append({"text" : f"{prefixes[block['type']]}{plain}\n", "metadata" : { "type" : block["type"], "block_id" : block["id"] }})
-                    
-            
-            return notion_text_blocks
+            return self._extract_text_blocks(response.json())
         else:
-            print(f"Request failed with status code {response.status_code}: {response.text}")
-            return "ERROR"
\ No newline at end of file
+            self._raise_text_blocks_request_failed(block_id, response.status_code, response.text)
+
+    async def _aget_text_blocks_by_notion_page_id(self, http_client, block_id):
+        response = await http_client.get(f'https://api.notion.com/v1/blocks/{block_id}/children?page_size=100')
+        record_usage(api_calls=1)
+
+        if response.status_code == 200:
+            return self._extract_text_blocks(response.json())
+        else:
+            self._raise_text_blocks_request_failed(block_id, response.status_code, response.text)
+
+    def _raise_text_blocks_request_failed(self, block_id, status_code, text):
+        # Without the content, the step must not write an output
+        message = f"Request for text blocks of Notion page >{block_id}< failed with status code {status_code}: {text}"
+        log(message, type="error")
+        raise RuntimeError(message)
+
+    def _extract_text_blocks(self, resp_json):
+        notion_text_blocks = []
+        for block in resp_json["results"]:
+
+            # TODO: Do we need other block types?
+            if block["type"] in ["paragraph", "bulleted_list_item", "numbered_list_item", "heading_1", "heading_2", "heading_3"]:
+                plain = ""
+                for rt in block[block["type"]]["rich_text"]:
+                    plain += rt["plain_text"]         
+                
+                prefixes = { "paragraph" : "", "bulleted_list_item" : "- ", "numbered_list_item" : "- ", "heading_1" : "# ", "heading_2" : "## ", "heading_3" : "### " }
+                notion_text_blocks.append({"text" : f"{prefixes[block['type']]}{plain}\n", "metadata" : { "type" : block["type"], "block_id" : block["id"] }})
+
+        return notion_text_blocks
+
+    def _get_notion_headers(self):
+        return {
+            'Notion-Version': '2022-06-28',
+            'Authorization': f'Bearer {self.notion_api_key}',
+        }
@@ -1,6 +1,8 @@
 from ai4teaching import DocumentProcessor
+from ai4teaching import ProcessingPipeline
 from ai4teaching import EmbeddingModel
 from ai4teaching.utils import log
+import functools
 
 class PDFProcessor(DocumentProcessor):
     def __init__(self, document, processed_documents_path, embedding_model: EmbeddingModel):
@@ -11,21 +13,49 @@ class PDFProcessor(DocumentProcessor):
     def process(self):
         log(f"Processing PDF from >{self.document['document_uri']}<", type="info")
 
-        self._extract_text_from_pdf()
+        self._run_pipeline(self._create_pipeline())
 
-        self._create_document_chunks(DocumentProcessor.STEP_EXTRACT_TEXT_FROM_PDF)
+        self.document["processing_outputs"] = self.step_ouput_files
 
-        self._embed_document_chunks(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        log(f"✔ Done processing PDF from >{self.document['document_uri']}<", type="success")
+        return self.document
+
+    async def aprocess(self):
+        log(f"Processing PDF from >{self.document['document_uri']}<", type="info")
+
+        # Partitioning and chunking are CPU bound, the pipeline runs them off the event loop
+        await self._arun_pipeline(self._create_pipeline())
 
         self.document["processing_outputs"] = self.step_ouput_files
 
         log(f"✔ Done processing PDF from >{self.document['document_uri']}<", type="success")
         return self.document
     
+    def _create_pipeline(self):
+        pipeline = ProcessingPipeline(self.document["title"])
+
+        pipeline.add_step(DocumentProcessor.STEP_EXTRACT_TEXT_FROM_PDF, self._extract_text_from_pdf)
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, 
+            functools.partial(self._create_document_chunks, DocumentProcessor.STEP_EXTRACT_TEXT_FROM_PDF), 
+            inputs=[DocumentProcessor.STEP_EXTRACT_TEXT_FROM_PDF]
+        )
+
+        pipeline.add_step(
+            DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, 
+            functools.partial(self._embed_document_chunks, DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS), 
+            inputs=[DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS],
+            async_function=functools.partial(self._aembed_document_chunks, DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        )
+
+        return pipeline
+
     def _extract_text_from_pdf(self):
         processing_required = self._prepare_and_check_if_processing_step_required(
             DocumentProcessor.STEP_EXTRACT_TEXT_FROM_PDF, 
-            previous_step_output_created_date=self._get_last_edited_time(self.document["document_uri"])
+            previous_step_output_created_date=self._get_last_edited_time(self.document["document_uri"]),
+            inputs={ "pdf_file" : self._hash_file(self.document["document_uri"]) }
         )
 
         if not processing_required:
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import contextvars
+import time
+from ai4teaching.utils import log, track_usage
+
+class ProcessingPipeline:
+    '''
+    Runs the processing steps of a document as a dependency graph. Each step declares the
+    steps whose results it reads (inputs). A step starts as soon as all its inputs are done,
+    so independent steps run at the same time, at most max_concurrency of them. If a step
+    fails, no further steps are started, the steps that are already running are finished
+    and the first error is raised. Optional steps only log their error, the steps that read
+    from them are not run.
+
+    For each step, the wall time, the API calls and the bytes written are collected in
+    self.metrics, keyed by step name.
+    '''
+    def __init__(self, name, max_concurrency=4):
+        self.name = name
+        self.max_concurrency = max_concurrency
+
+        self.steps = {}
+        self.metrics = {}
+
+    '''
+    function() runs the step. async_function() is used by arun() if given, otherwise arun()
+    runs function() in a worker thread.
+    '''
+    def add_step(self, step_name, function, inputs=None, async_function=None, optional=False):
+        if step_name in self.steps:
+            raise ValueError(f"Step >{step_name}< is already part of the pipeline")
+
+        self.steps[step_name] = { "function" : function, "async_function" : async_function, "inputs" : list(inputs or []), "optional" : optional }
+
+    def run(self):
+        self._validate()
+
+        done = set()
+        errors = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) as executor:
+            while True:
+                if len(errors) == 0:
+                    for step_name in self._get_ready_steps(done, running):
+                        # Each step counts its usage in its own context
+                        running[executor.submit(contextvars.copy_context().run, self._run_step, step_name)] = step_name
+
+                if len(running) == 0:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step_name = running.pop(future)
+                    if future.exception() is not None:
+                        self._handle_error(step_name, future.exception(), errors)
+                    else:
+                        done.add(step_name)
+
+        self._finish(done, errors)
+
+    async def arun(self):
+        self._validate()
+
+        done = set()
+        errors = []
+        running = {}
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+
+        async def run_with_limit(step_name):
+            async with semaphore:
+                await self._arun_step(step_name)
+
+        while True:
+            if len(errors) == 0:
+                for step_name in self._get_ready_steps(done, running):
+                    running[asyncio.create_task(run_with_limit(step_name))] = step_name
+
+            if len(running) == 0:
+                break
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                step_name = running.pop(task)
+                if task.exception() is not None:
+                    self._handle_error(step_name, task.exception(), errors)
+                else:
+                    done.add(step_name)
+
+        self._finish(done, errors)
+
+    def get_metrics(self):
+        return self.metrics
+
+    def _get_ready_steps(self, done, running):
+        started = done | set(running.values()) | set(self.metrics)
+        return [step_name for step_name, step in self.steps.items() if step_name not in started and all(input in done for input in step["inputs"])]
+
+    def _run_step(self, step_name):
+        start = time.perf_counter()
+        with track_usage() as usage:
+            try:
+                self.steps[step_name]["function"]()
+            finally:
+                self._record_metrics(step_name, start, usage)
+
+    async def _arun_step(self, step_name):
+        step = self.steps[step_name]
+        start = time.perf_counter()
+        with track_usage() as usage:
+            try:
+                if step["async_function"] is not None:
+                    await step["async_function"]()
+                else:
+                    await asyncio.to_thread(step["function"])
+            finally:
+                self._record_metrics(step_name, start, usage)
+
+    def _handle_error(self, step_name, error, errors):
+        if self.steps[step_name]["optional"]:
+            log(f"Optional step >{step_name}< of >{self.name}< failed: {error}", type="error")
+            return
+        errors.append(error)
+
+    def _record_metrics(self, step_name, start, usage):
+        self.metrics[step_name] = {
+            "wall_time" : time.perf_counter() - start,
+            "api_calls" : usage["api_calls"],
+            "bytes_written" : usage["bytes_written"]
+        }
+
+    def _validate(self):
+        self.metrics = {}
+        for step_name, step in self.steps.items():
+            for input in step["inputs"]:
+                if input not in self.steps:
+                    raise ValueError(f"Step >{step_name}< reads from >{input}<, which is not part of the pipeline")
+
+        # Every step has to be reachable, otherwise the graph has a cycle
+        done = set()
+        while len(done) < len(self.steps):
+            ready = [step_name for step_name, step in self.steps.items() if step_name not in done and all(input in done for input in step["inputs"])]
+            if len(ready) == 0:
+                raise ValueError(f"Steps of pipeline >{self.name}< have cyclic inputs")
+            done.update(ready)
+
+    def _finish(self, done, errors):
+        for step_name, metrics in self.metrics.items():
+            log(f"Step >{step_name}< of >{self.name}< took {metrics['wall_time']:.2f} s with {metrics['api_calls']} API calls and {metrics['bytes_written']} bytes written", type="debug")
+
+        if len(errors) > 0:
+            not_run = [step_name for step_name in self.steps if step_name not in self.metrics]
+            if len(not_run) > 0:
+                log(f"Steps {not_run} of >{self.name}< were not run because an earlier step failed", type="warning")
+            raise errors[0]
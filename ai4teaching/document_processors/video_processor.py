@@ -1,10 +1,17 @@
 from ai4teaching import DocumentProcessor
+from ai4teaching import ProcessingPipeline
 from ai4teaching import EmbeddingModel
 from ai4teaching import LargeLanguageModel
-from ai4teaching.utils import log
+from ai4teaching import get_openai_client, get_async_openai_client
+from ai4teaching.utils import log, record_usage
 from pytube import YouTube
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import contextvars
+import functools
 import json
 import math
+import os
 
 class VideoProcessor(DocumentProcessor):
     def __init__(self, document, processed_documents_path, embedding_model: EmbeddingModel, llm: LargeLanguageModel):
@@ -21,32 +28,80 @@ class VideoProcessor(DocumentProcessor):
     def process(self):
         log(f"Processing video document from >{self.document['document_uri']}<", type="info")
 
+        self._run_pipeline(self._create_pipeline())
+
+        self.document["processing_outputs"] = self.step_ouput_files
+
+        log(f"✔ Done processing video document from >{self.document['document_uri']}<", type="success")
+
+        return self.document
+
+    async def aprocess(self):
+        log(f"Processing video document from >{self.document['document_uri']}<", type="info")
+
+        # pytube has no async API, the pipeline downloads in a worker thread
+        await self._arun_pipeline(self._create_pipeline())
+
+        self.document["processing_outputs"] = self.step_ouput_files
+
+        log(f"✔ Done processing video document from >{self.document['document_uri']}<", type="success")
+
+        return self.document
+
+    '''
+    Download, transcription, segmentation and chunking run one after the other. Embedding
+    and summarizing both only read the chunks, so they run at the same time. Summaries are
+    optional, the video is searchable without them.
+    '''
+    def _create_pipeline(self):
+        pipeline = ProcessingPipeline(self.document["title"])
+
         # Download the audio from the video
-        self._extract_audio_from_youtube()
+        pipeline.add_step(DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE, self._extract_audio_from_youtube)
 
         # Transcribe the audio
-        self._transcribe_audio()
+        pipeline.add_step(
+            DocumentProcessor.STEP_TRANSCRIBE_AUDIO, 
+            self._transcribe_audio, 
+            inputs=[DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE],
+            async_function=self._atranscribe_audio
+        )
 
         # Split the transcript into overlapping segments
-        self._create_transript_segments(segment_length=120, overlap_length=30)
+        pipeline.add_step(
+            DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS, 
+            functools.partial(self._create_transript_segments, segment_length=120, overlap_length=30), 
+            inputs=[DocumentProcessor.STEP_TRANSCRIBE_AUDIO]
+        )
 
         # Create the processed document file with chunks
-        self._create_document_chunks(previous_step_name=DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS)
+        pipeline.add_step(
+            DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, 
+            functools.partial(self._create_document_chunks, previous_step_name=DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS), 
+            inputs=[DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS]
+        )
 
         # Embed the chunks
-        self._embed_document_chunks(previous_step_name=DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        pipeline.add_step(
+            DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS, 
+            functools.partial(self._embed_document_chunks, previous_step_name=DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS), 
+            inputs=[DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS],
+            async_function=functools.partial(self._aembed_document_chunks, previous_step_name=DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        )
 
         # Summarize the chunks
-        #self._summarize_document_chunks()
-
-        self.document["processing_outputs"] = self.step_ouput_files
+        pipeline.add_step(
+            DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS, 
+            functools.partial(self._summarize_document_chunks, previous_step_name=DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS), 
+            inputs=[DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS],
+            async_function=functools.partial(self._asummarize_document_chunks, previous_step_name=DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS),
+            optional=True
+        )
 
-        log(f"✔ Done processing video document from >{self.document['document_uri']}<", type="success")
-
-        return self.document
+        return pipeline
 
     def _extract_audio_from_youtube(self):
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE)
+        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE, inputs={ "document_uri" : self.document["document_uri"] })
 
         if not processing_required:
             return
@@ -54,22 +109,47 @@ class VideoProcessor(DocumentProcessor):
         yt = YouTube(self.document["document_uri"])
         stream = yt.streams.filter(only_audio=True).first()
         stream.download(filename=self.step_ouput_files[DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE])
+        record_usage(bytes_written=os.path.getsize(self.step_ouput_files[DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE]))
+        self._record_step_fingerprint(DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE)
 
     def _transcribe_audio(self):
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_TRANSCRIBE_AUDIO)
+        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_TRANSCRIBE_AUDIO, previous_step_name=DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE, parameters={ "transcription_model" : "whisper-1" })
 
         if not processing_required:
             return
 
-        from openai import OpenAI
-        client = OpenAI()
+        client = get_openai_client()
         audio_file = open(self.step_ouput_files[DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE], "rb")
         response = client.audio.transcriptions.create(
             model="whisper-1", 
             file=audio_file, 
             response_format="verbose_json"
             )
+        audio_file.close()
+        record_usage(api_calls=1)
+
+        # Save transcript to file
+        self._save_json_file_for_step(DocumentProcessor.STEP_TRANSCRIBE_AUDIO, self._create_transcript_document(response))
+
+    async def _atranscribe_audio(self):
+        processing_required = await asyncio.to_thread(self._prepare_and_check_if_processing_step_required, DocumentProcessor.STEP_TRANSCRIBE_AUDIO, previous_step_name=DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE, parameters={ "transcription_model" : "whisper-1" })
+
+        if not processing_required:
+            return
+
+        client = get_async_openai_client()
+        with open(self.step_ouput_files[DocumentProcessor.STEP_EXTRACT_AUDIO_FROM_YOUTUBE], "rb") as audio_file:
+            response = await client.audio.transcriptions.create(
+                model="whisper-1", 
+                file=audio_file, 
+                response_format="verbose_json"
+                )
+            record_usage(api_calls=1)
+
+        # Save transcript to file
+        await asyncio.to_thread(self._save_json_file_for_step, DocumentProcessor.STEP_TRANSCRIBE_AUDIO, self._create_transcript_document(response))
 
+    def _create_transcript_document(self, response):
         # Initialize summary JSON with mandatory fields
         transcript_document = self._get_mandatory_document_data()
 
@@ -91,12 +171,15 @@ class VideoProcessor(DocumentProcessor):
             }
             segment["text"] = s["text"]
             transcript_segments.append(segment)
-       
-        # Save transcript to file
-        self._save_json_file_for_step(DocumentProcessor.STEP_TRANSCRIBE_AUDIO, transcript_document)
+
+        return transcript_document
         
     def _create_transript_segments(self, segment_length=60, overlap_length=20):
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS)
+        processing_required = self._prepare_and_check_if_processing_step_required(
+            DocumentProcessor.STEP_CREATE_TRANSCRIPT_SEGMENTS, 
+            previous_step_name=DocumentProcessor.STEP_TRANSCRIBE_AUDIO,
+            parameters={ "segment_length" : segment_length, "overlap_length" : overlap_length }
+        )
 
         if not processing_required:
             return
@@ -173,9 +256,10 @@ class VideoProcessor(DocumentProcessor):
         chunks_document["metadata"] = transcript_segments["metadata"] if "metadata" in transcript_segments else {}
         chunks_document["chunks"] = []
         
-        for i, segment in enumerate(transcript_segments["content"]):
+        seen_chunk_ids = set()
+        for segment in transcript_segments["content"]:
             chunk = { 
-                "chunk_id" : f"{chunks_document['id']}_{i}",
+                "chunk_id" : self._create_chunk_id(segment["text"], seen_chunk_ids),
                 "metadata" : segment["metadata"] if "metadata" in segment else {},
                 "content" : segment["text"]
             }
@@ -185,23 +269,121 @@ class VideoProcessor(DocumentProcessor):
         # Save output file
         self._save_json_file_for_step(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS, chunks_document)
 
-    def _summarize_document_chunks(self):
-        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS)
+    '''
+    Summarizes the chunks with up to max_concurrency requests at the same time. Each finished
+    summary is written to the step checkpoint right away, so an interrupted run continues with
+    the chunks that have no summary yet. Summaries of unchanged chunks are taken over from the
+    previous output.
+    '''
+    def _summarize_document_chunks(self, previous_step_name=None, max_concurrency=8):
+        processing_required = self._prepare_and_check_if_processing_step_required(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS, previous_step_name=previous_step_name, parameters={ "summary_model" : self.llm.model_name })
 
         if not processing_required:
             return
 
+        summary_document, pending_chunks, checkpoint_summary = self._prepare_summarization_of_document_chunks()
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = { executor.submit(contextvars.copy_context().run, self.llm.summarize, chunk["content"]) : chunk for chunk in pending_chunks }
+            for future in as_completed(futures):
+                try:
+                    checkpoint_summary(futures[future], future.result())
+                except Exception as e:
+                    # Keep the other summaries, they are in the checkpoint for the next run
+                    log(f"Summarizing chunk >{futures[future]['chunk_id']}< failed: {e}", type="error")
+                    errors.append(e)
+
+        if len(errors) > 0:
+            self._log_incomplete_summarization(errors, summary_document)
+            return
+
+        self._finish_summarization_of_document_chunks(summary_document)
+
+    async def _asummarize_document_chunks(self, previous_step_name=None, max_concurrency=8):
+        processing_required = await asyncio.to_thread(self._prepare_and_check_if_processing_step_required, DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS, previous_step_name=previous_step_name, parameters={ "summary_model" : self.llm.model_name })
+
+        if not processing_required:
+            return
+
+        summary_document, pending_chunks, checkpoint_summary = await asyncio.to_thread(self._prepare_summarization_of_document_chunks)
+
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def summarize(chunk):
+            async with semaphore:
+                checkpoint_summary(chunk, await self.llm.asummarize(chunk["content"]))
+
+        results = await asyncio.gather(*[summarize(chunk) for chunk in pending_chunks], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            log(f"Summarizing a chunk failed: {error}", type="error")
+
+        if len(errors) > 0:
+            self._log_incomplete_summarization(errors, summary_document)
+            return
+
+        await asyncio.to_thread(self._finish_summarization_of_document_chunks, summary_document)
+
+    '''
+    Loads the chunks and the summaries that are already known from the previous output and
+    the checkpoint. Returns the summary document, the chunks that still need a summary and a
+    callback that adds a finished summary to the document and the checkpoint
+    '''
+    def _prepare_summarization_of_document_chunks(self):
         # Load chunks file
-        embedded_chunks = self._load_json_file_for_step(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
+        chunks_document = self._load_json_file_for_step(DocumentProcessor.STEP_CREATE_DOCUMENT_CHUNKS)
 
         # Initialize summary JSON with mandatory data
         summary_document = self._get_mandatory_document_data()
+        summary_document["summary_model"] = self.llm.model_name
 
-        chunks = [chunk for chunk in embedded_chunks["chunks"]]
-        
-        # Summarize each chunk
-        summary_document["content"] = [{ "summary" : self.llm.summarize(c["content"]), "chunk_id" : c["chunk_id"] } for c in chunks]
-        
+        model_name = self.llm.model_name
+        known_summaries = self._load_previous_summaries(model_name, chunks_document)
+        known_summaries.update({ record["content_hash"] : record["summary"] for record in self._load_step_checkpoint(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS) if record.get("model_name") == model_name })
+
+        summary_document["content"] = []
+        pending_chunks = []
+        summary_for_chunk_id = {}
+        for chunk in chunks_document["chunks"]:
+            content_hash = self._hash_text(chunk["content"])
+            summary_entry = { "summary" : known_summaries.get(content_hash), "chunk_id" : chunk["chunk_id"] }
+            summary_document["content"].append(summary_entry)
+            summary_for_chunk_id[chunk["chunk_id"]] = summary_entry
+            if summary_entry["summary"] is None:
+                pending_chunks.append(chunk)
+
+        log(f"Summarizing {len(pending_chunks)} of {len(chunks_document['chunks'])} chunks of >{self.document['title']}<", type="info")
+
+        def checkpoint_summary(chunk, summary):
+            summary_for_chunk_id[chunk["chunk_id"]]["summary"] = summary
+            self._append_to_step_checkpoint(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS, [{ "content_hash" : self._hash_text(chunk["content"]), "model_name" : model_name, "summary" : summary }])
+
+        return summary_document, pending_chunks, checkpoint_summary
+
+    def _load_previous_summaries(self, model_name, chunks_document):
+        previous_output_file_name = self.step_ouput_files[DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS]
+        if not os.path.isfile(previous_output_file_name):
+            return {}
+
+        with open(previous_output_file_name, "r", encoding="utf-8") as json_file:
+            previous_output = json.load(json_file)
+
+        if previous_output.get("summary_model") != model_name:
+            return {}
+
+        # Chunk ids are derived from the content hash, so they identify the summarized text
+        content_hash_for_chunk_id = { chunk["chunk_id"] : self._hash_text(chunk["content"]) for chunk in chunks_document["chunks"] }
+
+        return { content_hash_for_chunk_id[entry["chunk_id"]] : entry["summary"] for entry in previous_output["content"] if entry["chunk_id"] in content_hash_for_chunk_id and entry.get("summary") is not None }
+
+    def _log_incomplete_summarization(self, errors, summary_document):
+        # Summaries are optional, the document stays searchable without them. The output is not
+        # written, so the next run summarizes the missing chunks, the others are in the checkpoint
+        num_missing = sum(1 for entry in summary_document["content"] if entry["summary"] is None)
+        log(f"Summaries of {num_missing} chunks of >{self.document['title']}< are missing after {len(errors)} failed requests, they are created on the next run", type="warning")
+
+    def _finish_summarization_of_document_chunks(self, summary_document):
         # Write to file
         self._save_json_file_for_step(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS, summary_document)
-        
\ No newline at end of file
+        self._remove_step_checkpoint(DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS)
@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from ai4teaching.utils import log, make_sure_directory_exists
+
+class JSONIndexStore:
+    '''
+    Stores the knowledge base index in a single JSON file. Every save rewrites the file,
+    so it is only safe for one process at a time.
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as index_file:
+            return json.load(index_file)
+
+    def save(self, index):
+        with open(self.path, "w", encoding="utf-8") as index_file:
+            json.dump(index, index_file, indent=4, ensure_ascii=False)
+
+    def save_document(self, index, document):
+        # A JSON file can not be updated in parts
+        self.save(index)
+
+    def save_documents(self, index, documents):
+        self.save(index)
+
+    def delete_document(self, index, document):
+        self.save(index)
+
+    def close(self):
+        pass
+
+class SQLiteIndexStore:
+    '''
+    Stores the knowledge base index in SQLite. Documents, their step outputs and their status
+    are rows of their own, so adding or processing a document writes only that document in one
+    transaction. WAL mode lets several ingestion processes read and write the same index.
+    Saves never delete rows that are missing in memory, another process may have added them;
+    documents are only removed with delete_document().
+    '''
+
+    # Keys of a document that are kept in their own tables
+    SEPARATE_KEYS = ["processing_outputs", "status"]
+
+    def __init__(self, path, timeout=30.0):
+        self.path = os.path.abspath(path)
+
+        make_sure_directory_exists(os.path.dirname(self.path))
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS properties (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    document_uri TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS step_outputs (
+                    document_uri TEXT NOT NULL REFERENCES documents (document_uri) ON DELETE CASCADE,
+                    step_name TEXT NOT NULL,
+                    output_file TEXT NOT NULL,
+                    PRIMARY KEY (document_uri, step_name)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS status (
+                    document_uri TEXT PRIMARY KEY REFERENCES documents (document_uri) ON DELETE CASCADE,
+                    status TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+
+        log(f"Using knowledge base index >{self.path}<", type="debug")
+
+    '''
+    Returns the index in the same structure as the JSON index file
+    '''
+    def load(self):
+        with self._lock:
+            index = { key : json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM properties") }
+
+            step_outputs = {}
+            for document_uri, step_name, output_file in self._connection.execute("SELECT document_uri, step_name, output_file FROM step_outputs"):
+                step_outputs.setdefault(document_uri, {})[step_name] = output_file
+
+            statuses = dict(self._connection.execute("SELECT document_uri, status FROM status"))
+
+            documents = []
+            for document_uri, data in self._connection.execute("SELECT document_uri, data FROM documents ORDER BY position"):
+                document = json.loads(data)
+                if document_uri in step_outputs:
+                    document["processing_outputs"] = step_outputs[document_uri]
+                if document_uri in statuses:
+                    document["status"] = statuses[document_uri]
+                documents.append(document)
+
+        index["documents"] = documents
+        return index
+
+    '''
+    Writes the properties and all documents of the index in one transaction. Rows that did
+    not change are left alone.
+    '''
+    def save(self, index):
+        with self._lock, self._connection:
+            for key, value in index.items():
+                if key != "documents":
+                    self._connection.execute("INSERT OR REPLACE INTO properties (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+            for document in index.get("documents", []):
+                self._write_document(document)
+
+    '''
+    Writes a single document (and the index properties, which are small) in one transaction
+    '''
+    def save_document(self, index, document):
+        with self._lock, self._connection:
+            for key, value in index.items():
+                if key != "documents":
+                    self._connection.execute("INSERT OR REPLACE INTO properties (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+            self._write_document(document)
+
+    '''
+    Writes the given documents (and the index properties) in one transaction. The other
+    documents are left alone, another process may have changed them since they were loaded.
+    '''
+    def save_documents(self, index, documents):
+        with self._lock, self._connection:
+            for key, value in index.items():
+                if key != "documents":
+                    self._connection.execute("INSERT OR REPLACE INTO properties (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+            for document in documents:
+                self._write_document(document)
+
+    def delete_document(self, index, document):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM documents WHERE document_uri = ?", (document["document_uri"],))
+
+    '''
+    Replaces the content of the store with a JSON index file
+    '''
+    def import_json(self, json_file):
+        with open(json_file, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM documents")
+            self._connection.execute("DELETE FROM properties")
+
+        self.save(index)
+        log(f"Imported {len(index.get('documents', []))} documents from >{json_file}< into >{self.path}<", type="success")
+
+    def export_json(self, json_file):
+        index = self.load()
+        with open(json_file, "w", encoding="utf-8") as index_file:
+            json.dump(index, index_file, indent=4, ensure_ascii=False)
+        log(f"Exported {len(index['documents'])} documents from >{self.path}< to >{json_file}<", type="success")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    # Has to be called with the lock held and inside a transaction
+    def _write_document(self, document):
+        document_uri = document["document_uri"]
+        data = json.dumps({ key : value for key, value in document.items() if key not in SQLiteIndexStore.SEPARATE_KEYS }, ensure_ascii=False)
+        now = time.time()
+
+        row = self._connection.execute("SELECT data FROM documents WHERE document_uri = ?", (document_uri,)).fetchone()
+        if row is None:
+            # New documents go to the end, also when other processes added documents in the meantime
+            position = self._connection.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM documents").fetchone()[0]
+            self._connection.execute("INSERT INTO documents (document_uri, position, data, updated) VALUES (?, ?, ?, ?)", (document_uri, position, data, now))
+        elif row[0] != data:
+            self._connection.execute("UPDATE documents SET data = ?, updated = ? WHERE document_uri = ?", (data, now, document_uri))
+
+        step_outputs = document.get("processing_outputs", {})
+        stored_step_outputs = dict(self._connection.execute("SELECT step_name, output_file FROM step_outputs WHERE document_uri = ?", (document_uri,)))
+        if stored_step_outputs != step_outputs:
+            self._connection.execute("DELETE FROM step_outputs WHERE document_uri = ?", (document_uri,))
+            self._connection.executemany(
+                "INSERT INTO step_outputs (document_uri, step_name, output_file) VALUES (?, ?, ?)",
+                [(document_uri, step_name, output_file) for step_name, output_file in step_outputs.items()]
+            )
+
+        if "status" in document:
+            row = self._connection.execute("SELECT status FROM status WHERE document_uri = ?", (document_uri,)).fetchone()
+            if row is None or row[0] != document["status"]:
+                self._connection.execute("INSERT OR REPLACE INTO status (document_uri, status, updated) VALUES (?, ?, ?)", (document_uri, document["status"], now))
+        else:
+            self._connection.execute("DELETE FROM status WHERE document_uri = ?", (document_uri,))
@@ -1,41 +1,186 @@
+import asyncio
+import copy
+from collections import OrderedDict
 import json
 import os
+import threading
+import time
 from ai4teaching import log
 from ai4teaching import EmbeddingModel
 from ai4teaching import LargeLanguageModel
 from ai4teaching import DocumentProcessor
 
 class KnowledgeBase:
+
+    PROCESSING_MODE_BLOCKING = "blocking"
+    PROCESSING_MODE_BACKGROUND = "background"
+    PROCESSING_MODE_LAZY = "lazy"
     
-    def __init__(self, index_file_name, embedding_model: EmbeddingModel, llm: LargeLanguageModel):
+    '''
+    With processing_mode "blocking", all documents are processed before the constructor
+    returns. With "background", the index is loaded and the documents are processed on a
+    worker thread, while the documents that are already processed can be used. With "lazy",
+    nothing is processed until process() or start_background_processing() is called.
+    '''
+    def __init__(self, index_file_name, embedding_model: EmbeddingModel, llm: LargeLanguageModel, processing_mode=PROCESSING_MODE_BLOCKING, max_cached_step_outputs=32):
         self.embedding_model = embedding_model
         self.llm = llm
+        self.processing_mode = processing_mode
+
+        # Lookup tables for the documents of the index, kept up to date when documents are added or processed
+        self._documents_by_id = {}
+        self._documents_by_uri = {}
+        self._documents_by_type = {}
+
+        # Parsed step output files (such as summaries) by path, least recently used first
+        self.max_cached_step_outputs = max_cached_step_outputs
+        self._step_output_cache = OrderedDict()
+        self._step_output_cache_lock = threading.Lock()
+
+        # Guards the index while a worker thread processes documents
+        self._index_lock = threading.RLock()
+        self._ready = threading.Event()
+        self._worker = None
+        self._document_processed_callbacks = []
+        self.progress = { "total" : 0, "processed" : 0, "failed" : 0, "current" : None, "started" : None, "finished" : None }
 
         self._setup(index_file_name)
 
     def _setup(self, index_file_name):
-        with open(index_file_name, encoding="utf-8") as index_file:
-            self.index_file = os.path.abspath(index_file.name)
-            self.index_directory = os.path.dirname(self.index_file)
-            self.index = json.load(index_file)
+        self.index_store = self._create_index_store(index_file_name)
+        self.index_file = self.index_store.path
+        self.index_directory = os.path.dirname(self.index_file)
+        self.index = self.index_store.load()
         
         # Iterate through all documents in the index and check if they are processed
         if "documents" not in self.index:
             log(f"Knowledge base index does not contain documents. Adding empty list.", type="warning")
             self.index["documents"] = []
 
-        index_documents = self.index["documents"]
-        
+        self._rebuild_lookup_indexes()
+
+        if self.processing_mode == KnowledgeBase.PROCESSING_MODE_BACKGROUND:
+            self.start_background_processing()
+            return
+
+        if self.processing_mode == KnowledgeBase.PROCESSING_MODE_LAZY:
+            return
+
         # Process the documents in the index (steps are only performed if necessary)
-        for document in index_documents:
-            document = self._process_document(document)
-        
-        # Save the index file back to disk
-        self._save_index()
+        self.process()
+        self._ready.set()
         
-    def _save_index(self):
-        with open(self.index_file, "w", encoding="utf-8") as index_file:
-            json.dump(self.index, index_file, indent=4, ensure_ascii=False)
+    '''
+    Index files ending in .sqlite, .sqlite3 or .db are kept in SQLite, which writes documents
+    one by one and can be shared by several processes. All other files are read as JSON.
+    '''
+    def _create_index_store(self, index_file_name):
+        if os.path.splitext(index_file_name)[1].lower() in [".sqlite", ".sqlite3", ".db"]:
+            from ai4teaching import SQLiteIndexStore
+            return SQLiteIndexStore(index_file_name)
+
+        from ai4teaching import JSONIndexStore
+        return JSONIndexStore(index_file_name)
+
+    def _save_document(self, document):
+        with self._index_lock:
+            self.index_store.save_document(self.index, document)
+
+    # Only the documents that were changed are written, other workers may have updated the rest
+    def _save_documents(self, documents):
+        with self._index_lock:
+            self.index_store.save_documents(self.index, documents)
+
+    def _rebuild_lookup_indexes(self):
+        with self._index_lock:
+            self._documents_by_id = {}
+            self._documents_by_uri = {}
+            self._documents_by_type = {}
+            for document in self.index["documents"]:
+                self._add_to_lookup_indexes(document)
+
+    # Processing assigns ids to new documents
+    def _update_lookup_indexes(self, document):
+        with self._index_lock:
+            self._add_to_lookup_indexes(document)
+
+    # Has to be called with the index lock held
+    def _add_to_lookup_indexes(self, document):
+        if document.get("id") is not None:
+            self._documents_by_id[document["id"]] = document
+        self._documents_by_uri[document["document_uri"]] = document
+        self._documents_by_type.setdefault(document["type"], {})[document["document_uri"]] = document
+
+    '''
+    Processes the documents of the index on a worker thread. Each document is processed on
+    a copy, which replaces the document in the index once it is done, so that readers never
+    see a half processed document. The callbacks added with add_document_processed_callback()
+    are called on the worker thread after each document.
+    '''
+    def start_background_processing(self):
+        if self._worker is not None and self._worker.is_alive():
+            log(f"Knowledge base is already processing documents", type="warning")
+            return
+
+        self._ready.clear()
+        self._worker = threading.Thread(target=self._process_in_background, name="KnowledgeBaseWorker", daemon=True)
+        self._worker.start()
+
+    def add_document_processed_callback(self, callback):
+        self._document_processed_callbacks.append(callback)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    '''
+    Blocks until all documents are processed. Returns False if the timeout passed first.
+    '''
+    def wait_until_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def get_progress(self):
+        with self._index_lock:
+            return dict(self.progress)
+
+    def _process_in_background(self):
+        with self._index_lock:
+            documents = list(self.index["documents"])
+            self.progress.update({ "total" : len(documents), "processed" : 0, "failed" : 0, "current" : None, "started" : time.time(), "finished" : None })
+
+        log(f"Processing {len(documents)} documents of the knowledge base in the background", type="info")
+
+        for document in documents:
+            with self._index_lock:
+                self.progress["current"] = document.get("title", document["document_uri"])
+                document_copy = copy.deepcopy(document)
+
+            try:
+                processed_document = self._process_document(document_copy)
+            except Exception as e:
+                log(f"Processing document >{self.progress['current']}< failed: {e}", type="error")
+                with self._index_lock:
+                    self.progress["failed"] += 1
+                continue
+
+            with self._index_lock:
+                document.clear()
+                document.update(processed_document)
+                self._add_to_lookup_indexes(document)
+                self.progress["processed"] += 1
+                self._save_document(document)
+
+            for callback in self._document_processed_callbacks:
+                try:
+                    callback(document)
+                except Exception as e:
+                    log(f"Callback for processed document >{document.get('title')}< failed: {e}", type="error")
+
+        with self._index_lock:
+            self.progress["current"] = None
+            self.progress["finished"] = time.time()
+
+        log(f"Processed {self.progress['processed']} documents of the knowledge base in the background ({self.progress['failed']} failed)", type="success" if self.progress["failed"] == 0 else "warning")
+        self._ready.set()
    
     '''
     Check if the output files for a given process step exist.
@@ -43,7 +188,9 @@ class KnowledgeBase:
     '''
     def _get_output_files_for_process_step(self, step_name):
         output_files = []
-        for document in self.index["documents"]:
+        with self._index_lock:
+            documents = list(self.index["documents"])
+        for document in documents:
             if "status" in document:
                 if document["status"] == "inactive":
                     continue
@@ -66,54 +213,20 @@ class KnowledgeBase:
                 log(f"Skipping document >{document['title']}< because it is inactive", type="info")
                 return document
         
-        # Check if processing outputs are present
-        if "processing_outputs_path" not in self.index:
-            # Get the absolute path of the index_file and add subdirectory "outputs"
-            import os
-            processing_outputs_path = os.path.join(self.index_directory, "outputs")
-            log(f"Knowledge base index does not contain processing outputs path. Adding >{processing_outputs_path}< string.", type="warning")
-            self.index["processing_outputs_path"] = processing_outputs_path
-
-        type = document["type"]
-        if type == "text/plain":
-            return self._process_text_document(document)
-        elif type == "video/youtube":
-            return self._process_youtube_video(document)
-        elif type == "notion/page":
-            return self._process_notion_page(document)
-        elif type == "application/pdf":
-            return self._process_pdf_document(document)
-        else:
-            log(f"Document type >{type}< not supported", type="error")
+        processor = self._create_processor(document)
+        if processor is None:
             return document
 
-    def _process_text_document(self, document, processed_documents_path):
-        pass
-
-    def _process_youtube_video(self, document):
-        from ai4teaching import VideoProcessor
-        processor = VideoProcessor(document, self.index["processing_outputs_path"], self.embedding_model, self.llm)
-        processed_document = processor.process()
-        return processed_document
-    
-    def _process_notion_page(self, document):
-        from ai4teaching import NotionProcessor
-        processor = NotionProcessor(document, self.index["processing_outputs_path"], self.embedding_model)
-        processed_document = processor.process()
-        return processed_document
-
-    def _process_pdf_document(self, document):
-        from ai4teaching import PDFProcessor
-        processor = PDFProcessor(document, self.index["processing_outputs_path"], self.embedding_model)
-        processed_document = processor.process()
-        return processed_document
+        return processor.process()
 
     def get_embedded_chunks_files(self):
         return self._get_output_files_for_process_step(DocumentProcessor.STEP_EMBED_DOCUMENT_CHUNKS)
 
     def get_documents(self):
         active_documents = []
-        for doc in self.index["documents"]:
+        with self._index_lock:
+            documents = list(self.index["documents"])
+        for doc in documents:
             if "status" in doc:
                 if doc["status"] == "inactive":
                     continue
@@ -122,11 +235,8 @@ class KnowledgeBase:
         return active_documents
 
     def get_documents_by_type(self, type):
-        documents = []
-        for doc in self.index["documents"]:
-            if doc["type"] == type:
-                documents.append(doc)
-        return documents
+        with self._index_lock:
+            return list(self._documents_by_type.get(type, {}).values())
 
     ''' 
     Lookup the summary for a chunk_id in the summary file of the corresponding document
@@ -136,8 +246,11 @@ class KnowledgeBase:
         
         # Get document to get the summary file
         document = self.get_document_by_id(document_id)
+        if document is None:
+            log(f"Document >{document_id}< for chunk >{chunk_id}< not found in database index", type="warning")
+            return None
 
-        if DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS not in document["processing_outputs"]:
+        if DocumentProcessor.STEP_SUMMARIZE_DOCUMENT_CHUNKS not in document.get("processing_outputs", {}):
             log(f"Summary file for document >{document_id}< not found in database index", type="warning")
             return None
 
@@ -150,21 +263,50 @@ class KnowledgeBase:
             log(f"Summary file >{summary_file}< not found on disk", type="error")
             return None
         
-        # Open summary file and get the summary for the chunk_id
-        with open(summary_file, "r", encoding="utf-8") as json_file:
-            summary_document = json.load(json_file)
-            for chunk in summary_document["content"]:
-                if chunk["chunk_id"] == chunk_id:
-                    return chunk["summary"]
+        # Get the summary for the chunk_id from the parsed summary file
+        chunk = self._get_step_output_chunks_by_id(summary_file).get(chunk_id)
+        if chunk is not None:
+            return chunk["summary"]
+
+    '''
+    Returns the chunks of a step output file by chunk id. Parsed files are cached by path and
+    modification time, so a file is read again only after it changed on disk. At most
+    max_cached_step_outputs files are kept, the least recently used ones are dropped first.
+    '''
+    def _get_step_output_chunks_by_id(self, step_output_file):
+        step_output_file = str(step_output_file)
+        stat = os.stat(step_output_file)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._step_output_cache_lock:
+            cached = self._step_output_cache.get(step_output_file)
+            if cached is not None and cached[0] == version:
+                self._step_output_cache.move_to_end(step_output_file)
+                return cached[1]
+
+        with open(step_output_file, "r", encoding="utf-8") as json_file:
+            step_output = json.load(json_file)
+        chunks_by_id = { chunk["chunk_id"] : chunk for chunk in step_output["content"] }
+
+        with self._step_output_cache_lock:
+            self._step_output_cache[step_output_file] = (version, chunks_by_id)
+            self._step_output_cache.move_to_end(step_output_file)
+            while len(self._step_output_cache) > self.max_cached_step_outputs:
+                self._step_output_cache.popitem(last=False)
+
+        return chunks_by_id
 
     '''
     Lookup the document in the database index by its id
     The documents contains the URI to all processing outputs
     '''
     def get_document_by_id(self, document_id):
-        for document in self.index["documents"]:
-            if document["id"] == document_id:
-                return document
+        with self._index_lock:
+            return self._documents_by_id.get(document_id)
+
+    def get_document_by_uri(self, document_uri):
+        with self._index_lock:
+            return self._documents_by_uri.get(document_uri)
 
     '''
     Add and process (if necessary) a YouTube video to the knowledge base
@@ -190,10 +332,12 @@ class KnowledgeBase:
         }
         
         #processed_document = self._process_youtube_video(document)
-        self.index["documents"].append(document)
+        with self._index_lock:
+            self.index["documents"].append(document)
+            self._add_to_lookup_indexes(document)
 
-        # Save the index file back to disk
-        self._save_index()
+            # Save the index file back to disk
+            self._save_document(document)
     
     def add_pdf_document(self, pdf_file):
         log(f"Adding PDF document >{pdf_file}< to knowledge base", type="info")
@@ -215,14 +359,15 @@ class KnowledgeBase:
             "type" : "application/pdf"
         }
 
-        # Check if document alreasy exists in index
-        for doc in self.index["documents"]:
-            if doc["document_uri"] == document["document_uri"]:
+        with self._index_lock:
+            # Check if document alreasy exists in index
+            if document["document_uri"] in self._documents_by_uri:
                 log(f"Document >{document['document_uri']}< already exists in index", type="error")
                 return
 
-        self.index["documents"].append(document)
-        self._save_index()
+            self.index["documents"].append(document)
+            self._add_to_lookup_indexes(document)
+            self._save_document(document)
 
     ''' 
     This function checks wether processing for any document in the index is necessary
@@ -230,7 +375,87 @@ class KnowledgeBase:
     '''
     def process(self):
         log(f"Processing documents in knowledge base", type="info")
-        for document in self.index["documents"]:
-            document = self._process_document(document)
+        changed_documents = []
+        try:
+            for document in self.index["documents"]:
+                previous_document = copy.deepcopy(document)
+                try:
+                    document = self._process_document(document)
+                    self._update_lookup_indexes(document)
+                finally:
+                    # Steps that finished before a failure are kept as well
+                    if document != previous_document:
+                        changed_documents.append(document)
+        finally:
+            self._save_documents(changed_documents)
+
+    '''
+    Async version of process(). Documents are processed concurrently, at most max_concurrency
+    at a time, so that the network bound steps of many documents overlap. Use it with
+    asyncio.run(knowledge_base.aprocess())
+    '''
+    async def aprocess(self, max_concurrency=8):
+        log(f"Processing documents in knowledge base with up to {max_concurrency} documents in parallel", type="info")
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        changed_documents = []
+
+        async def process_with_limit(document):
+            async with semaphore:
+                previous_document = copy.deepcopy(document)
+                try:
+                    document = await self._aprocess_document(document)
+                    self._update_lookup_indexes(document)
+                except Exception as e:
+                    log(f"Processing document >{document.get('title', document['document_uri'])}< failed: {e}", type="error")
+                    return e
+                finally:
+                    # Steps that finished before a failure are kept as well
+                    if document != previous_document:
+                        changed_documents.append(document)
+
+        results = await asyncio.gather(*[process_with_limit(document) for document in self.index["documents"]])
+
+        await asyncio.to_thread(self._save_documents, changed_documents)
+
+        num_failed = sum(1 for result in results if isinstance(result, Exception))
+        if num_failed > 0:
+            log(f"Processing failed for {num_failed} of {len(results)} documents", type="warning")
 
-        self._save_index()
\ No newline at end of file
+    async def _aprocess_document(self, document):
+        if "status" in document:
+            if document["status"] == "inactive":
+                log(f"Skipping document >{document['title']}< because it is inactive", type="info")
+                return document
+
+        # Processor constructors fetch titles over the network, create them in a worker thread
+        processor = await asyncio.to_thread(self._create_processor, document)
+        if processor is None:
+            return document
+
+        return await processor.aprocess()
+
+    '''
+    Returns the processor for the type of the document, or None if the type is not supported.
+    Both process() and aprocess() create their processors here.
+    '''
+    def _create_processor(self, document):
+        # Check if processing outputs are present
+        if "processing_outputs_path" not in self.index:
+            # Get the absolute path of the index_file and add subdirectory "outputs"
+            processing_outputs_path = os.path.join(self.index_directory, "outputs")
+            log(f"Knowledge base index does not contain processing outputs path. Adding >{processing_outputs_path}< string.", type="warning")
+            self.index["processing_outputs_path"] = processing_outputs_path
+
+        type = document["type"]
+        if type == "video/youtube":
+            from ai4teaching import VideoProcessor
+            return VideoProcessor(document, self.index["processing_outputs_path"], self.embedding_model, self.llm)
+        elif type == "notion/page":
+            from ai4teaching import NotionProcessor
+            return NotionProcessor(document, self.index["processing_outputs_path"], self.embedding_model)
+        elif type == "application/pdf":
+            from ai4teaching import PDFProcessor
+            return PDFProcessor(document, self.index["processing_outputs_path"], self.embedding_model)
+        else:
+            log(f"Document type >{type}< not supported", type="error")
+            return None
@@ -0,0 +1,34 @@
+import hashlib
+from array import array
+from ai4teaching.utils.sqlite_lru_store import SQLiteLRUStore
+
+class EmbeddingCache(SQLiteLRUStore):
+    '''
+    Persistent, content-addressed cache for embeddings. Entries are keyed by
+    the model name and the SHA-256 hash of the text and stored as float32 blobs
+    in a SQLite database. When the cache grows beyond max_entries, the least
+    recently used entries are evicted.
+    '''
+    def __init__(self, path, max_entries=500000):
+        super().__init__(path, "embedding_cache", max_entries=max_entries, name="embedding cache")
+
+    '''
+    Returns a list with the cached embedding for each text or None if the text is not cached
+    '''
+    def get_many(self, model_name, texts):
+        blobs = self.get_values([self._get_key(model_name, text) for text in texts])
+        return [self._blob_to_embedding(blob) if blob is not None else None for blob in blobs]
+
+    def put_many(self, model_name, texts, embeddings):
+        self.put_values([(self._get_key(model_name, text), self._embedding_to_blob(embedding)) for text, embedding in zip(texts, embeddings)])
+
+    def _get_key(self, model_name, text):
+        return f"{model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _embedding_to_blob(self, embedding):
+        return array("f", embedding).tobytes()
+
+    def _blob_to_embedding(self, blob):
+        embedding = array("f")
+        embedding.frombytes(blob)
+        return embedding.tolist()
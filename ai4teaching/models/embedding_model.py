@@ -1,13 +1,205 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import contextvars
+from types import SimpleNamespace
+from ai4teaching.utils import log, count_tokens
+from ai4teaching.models.openai_client import get_openai_client, get_async_openai_client
+from ai4teaching.models.rate_limiter import RateLimitScheduler, get_rate_limit_scheduler, without_client_retries
+
 class EmbeddingModel:
 
-    def __init__(self, model_name = "text-embedding-ada-002") -> None:
+    def __init__(self, model_name = "text-embedding-ada-002", cache=None, max_batch_size=2048, max_batch_tokens=250000, max_concurrency=4) -> None:
         self.model_name = model_name
 
-    def embed(self, document_list):
-        from openai import OpenAI
-        client = OpenAI()
-        embeddings = client.embeddings.create(input=document_list, model=self.model_name)
+        # Optional EmbeddingCache, only cache misses are sent to the API
+        self.cache = cache
+
+        # Limits for a single embeddings request and the number of parallel requests
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+
+    def embed(self, document_list, priority=RateLimitScheduler.PRIORITY_INTERACTIVE):
+        if self.cache is None:
+            return self._create_embeddings(document_list, priority)
+
+        texts, embeddings, missing_texts = self._lookup_cache(document_list)
+
+        if len(missing_texts) > 0:
+            log(f"Embedding {len(missing_texts)} of {len(texts)} texts with OpenAI API model {self.model_name} (cache misses)", type="debug")
+            response = self._create_embeddings(missing_texts, priority)
+            embeddings = self._merge_with_cache(texts, embeddings, missing_texts, response)
+
+        return self._create_response(embeddings)
+
+    async def aembed(self, document_list, priority=RateLimitScheduler.PRIORITY_INTERACTIVE):
+        if self.cache is None:
+            return await self._acreate_embeddings(document_list, priority)
+
+        texts, embeddings, missing_texts = await asyncio.to_thread(self._lookup_cache, document_list)
+
+        if len(missing_texts) > 0:
+            log(f"Embedding {len(missing_texts)} of {len(texts)} texts with OpenAI API model {self.model_name} (cache misses)", type="debug")
+            response = await self._acreate_embeddings(missing_texts, priority)
+            embeddings = await asyncio.to_thread(self._merge_with_cache, texts, embeddings, missing_texts, response)
+
+        return self._create_response(embeddings)
+
+    def _lookup_cache(self, document_list):
+        texts = [document_list] if isinstance(document_list, str) else list(document_list)
+        embeddings = self.cache.get_many(self.model_name, texts)
+
+        # Collect the texts that are not in the cache (each unique text only once)
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        return texts, embeddings, missing_texts
+
+    def _merge_with_cache(self, texts, embeddings, missing_texts, response):
+        missing_embeddings = [d.embedding for d in response.data]
+        self.cache.put_many(self.model_name, missing_texts, missing_embeddings)
+
+        embedding_for_text = dict(zip(missing_texts, missing_embeddings))
+        return [embedding if embedding is not None else embedding_for_text[text] for text, embedding in zip(texts, embeddings)]
+
+    def _create_response(self, embeddings):
+        # Mimic the structure of the OpenAI response so callers can use .data[i].embedding
+        return SimpleNamespace(
+            model=self.model_name,
+            data=[SimpleNamespace(index=i, embedding=embedding) for i, embedding in enumerate(embeddings)]
+        )
+
+    '''
+    Embeds a (potentially large) list of texts in batches that respect the per-request
+    item and token limits. Batches are sent with bounded concurrency. After each batch,
+    on_batch_embedded(indices, embeddings) is called so that callers can checkpoint
+    finished work. Returns the list of embeddings in the order of the texts.
+    '''
+    def embed_in_batches(self, texts, on_batch_embedded=None, max_concurrency=None):
+        max_concurrency = max_concurrency if max_concurrency is not None else self.max_concurrency
+        batches = self._create_batches(texts)
+        embeddings = [None] * len(texts)
+
+        if len(batches) == 0:
+            return embeddings
+
+        log(f"Embedding {len(texts)} texts in {len(batches)} batches with up to {max_concurrency} concurrent requests", type="debug")
+
+        def embed_batch(indices):
+            response = self.embed([texts[i] for i in indices], priority=RateLimitScheduler.PRIORITY_BATCH)
+            return indices, [d.embedding for d in response.data]
+
+        # Callbacks run on the calling thread, so checkpoint writes never interleave
+        first_error = None
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            # Each batch runs in a copy of the caller's context, so its API calls are counted for the caller
+            futures = [executor.submit(contextvars.copy_context().run, embed_batch, indices) for indices in batches]
+            for future in as_completed(futures):
+                try:
+                    indices, batch_embeddings = future.result()
+                except Exception as e:
+                    # Keep collecting the other batches so that their work is not lost
+                    log(f"Embedding batch failed: {e}", type="error")
+                    first_error = first_error or e
+                    continue
+
+                for i, embedding in zip(indices, batch_embeddings):
+                    embeddings[i] = embedding
+
+                if on_batch_embedded is not None:
+                    on_batch_embedded(indices, batch_embeddings)
+
+        if first_error is not None:
+            raise first_error
+
+        return embeddings
+
+    '''
+    Async version of embed_in_batches, the batches are sent concurrently on the event loop
+    '''
+    async def aembed_in_batches(self, texts, on_batch_embedded=None, max_concurrency=None):
+        max_concurrency = max_concurrency if max_concurrency is not None else self.max_concurrency
+        batches = self._create_batches(texts)
+        embeddings = [None] * len(texts)
+
+        if len(batches) == 0:
+            return embeddings
+
+        log(f"Embedding {len(texts)} texts in {len(batches)} batches with up to {max_concurrency} concurrent requests", type="debug")
+
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def embed_batch(indices):
+            async with semaphore:
+                response = await self.aembed([texts[i] for i in indices], priority=RateLimitScheduler.PRIORITY_BATCH)
+            return indices, [d.embedding for d in response.data]
+
+        first_error = None
+        for next_finished in asyncio.as_completed([embed_batch(indices) for indices in batches]):
+            try:
+                indices, batch_embeddings = await next_finished
+            except Exception as e:
+                # Keep collecting the other batches so that their work is not lost
+                log(f"Embedding batch failed: {e}", type="error")
+                first_error = first_error or e
+                continue
+
+            for i, embedding in zip(indices, batch_embeddings):
+                embeddings[i] = embedding
+
+            if on_batch_embedded is not None:
+                on_batch_embedded(indices, batch_embeddings)
+
+        if first_error is not None:
+            raise first_error
+
         return embeddings
 
+    def _create_batches(self, texts):
+        batches = []
+        current_batch = []
+        current_batch_tokens = 0
+
+        for i, text in enumerate(texts):
+            num_tokens = count_tokens(text, self.model_name)
+
+            if len(current_batch) > 0 and (len(current_batch) >= self.max_batch_size or current_batch_tokens + num_tokens > self.max_batch_tokens):
+                batches.append(current_batch)
+                current_batch = []
+                current_batch_tokens = 0
+
+            current_batch.append(i)
+            current_batch_tokens += num_tokens
+
+        if len(current_batch) > 0:
+            batches.append(current_batch)
+
+        return batches
+
+    def _create_embeddings(self, document_list, priority=RateLimitScheduler.PRIORITY_INTERACTIVE):
+        client = without_client_retries(get_openai_client())
+        embeddings = get_rate_limit_scheduler().run(
+            lambda: client.embeddings.create(input=document_list, model=self.model_name),
+            self.model_name,
+            estimated_tokens=self._count_tokens(document_list),
+            priority=priority
+        )
+        return embeddings
+
+    async def _acreate_embeddings(self, document_list, priority=RateLimitScheduler.PRIORITY_INTERACTIVE):
+        client = without_client_retries(get_async_openai_client())
+        embeddings = await get_rate_limit_scheduler().arun(
+            lambda: client.embeddings.create(input=document_list, model=self.model_name),
+            self.model_name,
+            estimated_tokens=self._count_tokens(document_list),
+            priority=priority
+        )
+        return embeddings
+
+    def _count_tokens(self, document_list):
+        texts = [document_list] if isinstance(document_list, str) else document_list
+        return sum(count_tokens(text, self.model_name) for text in texts)
+
     def get_stats(self):
-        return { "model_name" : self.model_name }       
\ No newline at end of file
+        stats = { "model_name" : self.model_name }
+        if self.cache is not None:
+            stats["cache"] = self.cache.get_stats()
+        return stats
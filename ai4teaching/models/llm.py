@@ -1,14 +1,28 @@
 from ai4teaching.utils import log
+from ai4teaching.models.openai_client import get_openai_client, get_async_openai_client
+from ai4teaching.models.rate_limiter import RateLimitScheduler, create_chat_completion, acreate_chat_completion
 class LargeLanguageModel:
 
     def __init__(self, model_name = "gpt-3.5-turbo-1106") -> None:
         self.model_name = model_name
 
-    def complete(self, messages):
-        from openai import OpenAI
-        client = OpenAI()
+    def complete(self, messages, priority=RateLimitScheduler.PRIORITY_BATCH):
+        client = get_openai_client()
         log(f"Creating completion with OpenAI API model {self.model_name}", type="debug")
-        response = client.chat.completions.create(
+        response = create_chat_completion(
+            client,
+            priority=priority,
+            model=self.model_name,
+            messages=messages
+        )
+        return response
+
+    async def acomplete(self, messages, priority=RateLimitScheduler.PRIORITY_BATCH):
+        client = get_async_openai_client()
+        log(f"Creating completion with OpenAI API model {self.model_name}", type="debug")
+        response = await acreate_chat_completion(
+            client,
+            priority=priority,
             model=self.model_name,
             messages=messages
         )
@@ -18,14 +32,23 @@ class LargeLanguageModel:
 
         log(f"Summarizing video chunk with OpenAI model {self.model_name}", type="debug")
 
-        messages=[
-            {"role": "system", "content": "You are a expert in summarizing texts and you agreed to summarize excerpts from speeches that are handed to."},
-            {"role": "user", "content": f"Please summarize the following excerpt from a lecture video in no more than 5-8 sentences. The speakers name is Nicolas: {text}. Please write your summary in German."}
-        ]
+        summary = self.complete(self._create_summary_messages(text))
+        
+        return summary.choices[0].message.content
+
+    async def asummarize(self, text):
+
+        log(f"Summarizing video chunk with OpenAI model {self.model_name}", type="debug")
 
-        summary = self.complete(messages)
+        summary = await self.acomplete(self._create_summary_messages(text))
         
         return summary.choices[0].message.content
+
+    def _create_summary_messages(self, text):
+        return [
+            {"role": "system", "content": "You are a expert in summarizing texts and you agreed to summarize excerpts from speeches that are handed to."},
+            {"role": "user", "content": f"Please summarize the following excerpt from a lecture video in no more than 5-8 sentences. The speakers name is Nicolas: {text}. Please write your summary in German."}
+        ]
     
 
     def set_model(self, model_name):
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import weakref
+from ai4teaching.utils import log
+
+# Process-wide OpenAI clients. All models and assistants share one client, so that
+# HTTP connections (and their TLS sessions) are kept alive and reused across calls.
+# The clients are thread-safe. Async clients are bound to an event loop, so there is
+# one async client per running loop.
+
+_lock = threading.Lock()
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_async_client_override = None
+
+_settings = {
+    "max_connections" : 100,
+    "max_keepalive_connections" : 20,
+    "keepalive_expiry" : 30.0,
+    "timeout" : 60.0,
+    "connect_timeout" : 10.0,
+    "max_retries" : 2
+}
+
+def configure_openai_client(**settings):
+    global _client
+
+    unknown_settings = set(settings) - set(_settings)
+    if len(unknown_settings) > 0:
+        log(f"Unknown OpenAI client settings {sorted(unknown_settings)} are ignored", type="warning")
+
+    with _lock:
+        _settings.update({ key : value for key, value in settings.items() if key in _settings })
+
+        # Clients are created again with the new settings on next use. The old clients are
+        # not closed, requests that still use them can finish, their connections are
+        # released once they are no longer referenced
+        _client = None
+        _async_clients.clear()
+
+def get_openai_client():
+    global _client
+    with _lock:
+        if _client is None:
+            from openai import OpenAI, DefaultHttpxClient
+            _client = OpenAI(
+                http_client=DefaultHttpxClient(limits=_get_limits(), timeout=_get_timeout()),
+                max_retries=_settings["max_retries"]
+            )
+            log(f"Created shared OpenAI client with up to {_settings['max_connections']} connections", type="debug")
+        return _client
+
+def get_async_openai_client():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if _async_client_override is not None:
+            return _async_client_override
+        if loop not in _async_clients:
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+            _async_clients[loop] = AsyncOpenAI(
+                http_client=DefaultAsyncHttpxClient(limits=_get_limits(), timeout=_get_timeout()),
+                max_retries=_settings["max_retries"]
+            )
+        return _async_clients[loop]
+
+'''
+Replaces the shared client, e.g. with a stand-in that implements the used parts of the API
+'''
+def set_openai_client(client):
+    global _client
+    with _lock:
+        _client = client
+
+'''
+Replaces the async clients of all event loops, None goes back to one client per loop
+'''
+def set_async_openai_client(client):
+    global _async_client_override
+    with _lock:
+        _async_client_override = client
+
+def _get_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=_settings["max_connections"],
+        max_keepalive_connections=_settings["max_keepalive_connections"],
+        keepalive_expiry=_settings["keepalive_expiry"]
+    )
+
+def _get_timeout():
+    import httpx
+    return httpx.Timeout(_settings["timeout"], connect=_settings["connect_timeout"])
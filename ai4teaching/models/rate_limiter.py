@@ -0,0 +1,297 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from ai4teaching.utils import log, count_tokens, record_usage
+
+# All OpenAI requests of the process go through one RateLimitScheduler, so that
+# background work (ingestion, bulk grading) and interactive work (chat) share the
+# limits of the account instead of running into 429 errors independently.
+
+class TokenBucket:
+    '''
+    Allows per_minute units per minute with bursts up to per_minute. A bucket
+    without a limit (per_minute=None) never waits.
+    '''
+    def __init__(self, per_minute=None):
+        self.per_minute = per_minute
+        self.tokens = per_minute or 0
+        self.updated = time.monotonic()
+
+    def get_wait_time(self, amount):
+        if self.per_minute is None:
+            return 0.0
+
+        self._refill()
+
+        # Requests larger than the bucket have to wait for a full bucket
+        amount = min(amount, self.per_minute)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / (self.per_minute / 60.0)
+
+    def consume(self, amount):
+        if self.per_minute is None:
+            return
+
+        self._refill()
+        self.tokens -= min(amount, self.per_minute)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+class RateLimitScheduler:
+    '''
+    Schedules API requests per model under a requests-per-minute and a tokens-per-minute
+    limit. Waiting requests are served by priority (interactive before batch) and in order
+    of arrival within a priority. Requests that fail with a rate limit, timeout, connection
+    or server error are retried with exponential backoff and full jitter. A rate limit error
+    pauses all requests for that model until the backoff has passed.
+    '''
+
+    PRIORITY_INTERACTIVE = "interactive"
+    PRIORITY_BATCH = "batch"
+
+    PRIORITIES = [PRIORITY_INTERACTIVE, PRIORITY_BATCH]
+
+    def __init__(self, limits=None, max_retries=5, initial_backoff=1.0, max_backoff=60.0):
+        # { model_name : { "requests_per_minute" : ..., "tokens_per_minute" : ... } }, "default" applies to all other models
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._queues = {}
+
+    '''
+    Runs request_function() once the limits of the model allow it and returns its result.
+    estimated_tokens is charged against the tokens-per-minute limit.
+    '''
+    def run(self, request_function, model_name, estimated_tokens=0, priority=PRIORITY_BATCH):
+        for attempt in range(self.max_retries + 1):
+            self._acquire(model_name, estimated_tokens, priority)
+            record_usage(api_calls=1)
+            try:
+                return request_function()
+            except Exception as e:
+                backoff = self._handle_error(e, model_name, attempt)
+                time.sleep(backoff)
+
+    '''
+    Async version of run(), request_function() has to return an awaitable
+    '''
+    async def arun(self, request_function, model_name, estimated_tokens=0, priority=PRIORITY_BATCH):
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire(model_name, estimated_tokens, priority)
+            record_usage(api_calls=1)
+            try:
+                return await request_function()
+            except Exception as e:
+                backoff = self._handle_error(e, model_name, attempt)
+                await asyncio.sleep(backoff)
+
+    def get_stats(self):
+        with self._condition:
+            stats = {}
+            for model_name, queue in self._queues.items():
+                queue_depth = { priority : 0 for priority in RateLimitScheduler.PRIORITIES }
+                for rank, _, _ in queue["waiting"]:
+                    queue_depth[RateLimitScheduler.PRIORITIES[rank]] += 1
+
+                wait_times = {}
+                for priority, (num_waits, total_wait_time, max_wait_time) in queue["wait_times"].items():
+                    wait_times[priority] = {
+                        "requests" : num_waits,
+                        "mean_wait_time" : total_wait_time / num_waits if num_waits > 0 else 0.0,
+                        "max_wait_time" : max_wait_time
+                    }
+
+                stats[model_name] = {
+                    "queue_depth" : queue_depth,
+                    "wait_times" : wait_times,
+                    "requests" : queue["requests"],
+                    "tokens" : queue["tokens"],
+                    "retries" : queue["retries"],
+                    "rate_limit_errors" : queue["rate_limit_errors"]
+                }
+            return stats
+
+    def _get_queue(self, model_name):
+        if model_name not in self._queues:
+            limits = self.limits.get(model_name, self.limits.get("default", {}))
+            self._queues[model_name] = {
+                "request_bucket" : TokenBucket(limits.get("requests_per_minute")),
+                "token_bucket" : TokenBucket(limits.get("tokens_per_minute")),
+                "waiting" : [],
+                "paused_until" : 0.0,
+                "wait_times" : { priority : (0, 0.0, 0.0) for priority in RateLimitScheduler.PRIORITIES },
+                "requests" : 0,
+                "tokens" : 0,
+                "retries" : 0,
+                "rate_limit_errors" : 0
+            }
+        return self._queues[model_name]
+
+    def _enqueue(self, model_name, estimated_tokens, priority):
+        if priority not in RateLimitScheduler.PRIORITIES:
+            raise ValueError(f"Unknown priority >{priority}<, expected one of {RateLimitScheduler.PRIORITIES}")
+
+        ticket = (RateLimitScheduler.PRIORITIES.index(priority), next(self._sequence), estimated_tokens)
+        with self._condition:
+            heapq.heappush(self._get_queue(model_name)["waiting"], ticket)
+        return ticket
+
+    '''
+    Returns 0 if the request may be sent now, the time to wait for the limits, or None
+    if other requests are ahead. Has to be called with the condition's lock held.
+    '''
+    def _try_acquire(self, model_name, ticket, enqueued_at):
+        queue = self._get_queue(model_name)
+        if queue["waiting"][0] != ticket:
+            return None
+
+        estimated_tokens = ticket[2]
+        wait_time = max(
+            queue["paused_until"] - time.monotonic(),
+            queue["request_bucket"].get_wait_time(1),
+            queue["token_bucket"].get_wait_time(estimated_tokens)
+        )
+        if wait_time > 0:
+            return wait_time
+
+        queue["request_bucket"].consume(1)
+        queue["token_bucket"].consume(estimated_tokens)
+        heapq.heappop(queue["waiting"])
+
+        priority = RateLimitScheduler.PRIORITIES[ticket[0]]
+        num_waits, total_wait_time, max_wait_time = queue["wait_times"][priority]
+        wait_time = time.monotonic() - enqueued_at
+        queue["wait_times"][priority] = (num_waits + 1, total_wait_time + wait_time, max(max_wait_time, wait_time))
+        queue["requests"] += 1
+        queue["tokens"] += estimated_tokens
+
+        # The next request in the queue may be able to go as well
+        self._condition.notify_all()
+        return 0
+
+    def _acquire(self, model_name, estimated_tokens, priority):
+        enqueued_at = time.monotonic()
+        ticket = self._enqueue(model_name, estimated_tokens, priority)
+
+        with self._condition:
+            while True:
+                wait_time = self._try_acquire(model_name, ticket, enqueued_at)
+                if wait_time == 0:
+                    return
+                self._condition.wait(timeout=wait_time)
+
+    async def _aacquire(self, model_name, estimated_tokens, priority):
+        enqueued_at = time.monotonic()
+        ticket = self._enqueue(model_name, estimated_tokens, priority)
+
+        try:
+            while True:
+                with self._condition:
+                    wait_time = self._try_acquire(model_name, ticket, enqueued_at)
+                if wait_time == 0:
+                    return
+                # The event loop can not wait on the condition, poll instead
+                await asyncio.sleep(min(wait_time, 0.05) if wait_time is not None else 0.01)
+        except asyncio.CancelledError:
+            with self._condition:
+                waiting = self._get_queue(model_name)["waiting"]
+                if ticket in waiting:
+                    waiting.remove(ticket)
+                    heapq.heapify(waiting)
+                    self._condition.notify_all()
+            raise
+
+    '''
+    Re-raises errors that can not be retried, otherwise returns the backoff time
+    '''
+    def _handle_error(self, error, model_name, attempt):
+        import openai
+
+        if not isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+            raise error
+
+        if attempt >= self.max_retries:
+            log(f"Request to >{model_name}< failed after {attempt + 1} attempts: {error}", type="error")
+            raise error
+
+        # Full jitter keeps clients that failed at the same time from retrying at the same time
+        backoff = random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+        # Respect the server's hint if there is one
+        retry_after = self._get_retry_after(error)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+
+        with self._condition:
+            queue = self._get_queue(model_name)
+            queue["retries"] += 1
+            if isinstance(error, openai.RateLimitError):
+                # Hold back all requests for this model, not only the failed one
+                queue["rate_limit_errors"] += 1
+                queue["paused_until"] = max(queue["paused_until"], time.monotonic() + backoff)
+
+        log(f"Request to >{model_name}< failed ({type(error).__name__}), retrying in {backoff:.1f} s (attempt {attempt + 1} of {self.max_retries})", type="warning")
+        return backoff
+
+    def _get_retry_after(self, error):
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+_scheduler_lock = threading.Lock()
+_scheduler = None
+
+def configure_rate_limits(limits=None, **settings):
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RateLimitScheduler(limits, **settings)
+
+def get_rate_limit_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler()
+        return _scheduler
+
+'''
+Returns a copy of the client that does not retry on its own. Requests that go through the
+scheduler are retried by the scheduler, retries of the client would multiply the attempts
+and send requests past the limits.
+'''
+def without_client_retries(client):
+    with_options = getattr(client, "with_options", None)
+    return with_options(max_retries=0) if with_options is not None else client
+
+'''
+Creates a chat completion through the shared scheduler. The prompt tokens are
+estimated from the messages and charged against the model's token limit.
+'''
+def create_chat_completion(client, priority=RateLimitScheduler.PRIORITY_BATCH, **kwargs):
+    estimated_tokens = _estimate_chat_tokens(kwargs)
+    client = without_client_retries(client)
+    return get_rate_limit_scheduler().run(lambda: client.chat.completions.create(**kwargs), kwargs["model"], estimated_tokens, priority)
+
+async def acreate_chat_completion(client, priority=RateLimitScheduler.PRIORITY_BATCH, **kwargs):
+    estimated_tokens = _estimate_chat_tokens(kwargs)
+    client = without_client_retries(client)
+    return await get_rate_limit_scheduler().arun(lambda: client.chat.completions.create(**kwargs), kwargs["model"], estimated_tokens, priority)
+
+def _estimate_chat_tokens(kwargs):
+    prompt = "\n".join(message["content"] for message in kwargs["messages"] if isinstance(message.get("content"), str))
+    return count_tokens(prompt, kwargs["model"]) + kwargs.get("max_tokens", 0)
@@ -6,15 +6,16 @@ class TextEmbedder:
 
     '''
     Takes a list of documents and embeds them using the OpenAI API. Requires the text to be stored in the "text" key of each document.
+    Large lists are split into batches that respect the API's per-request limits.
     '''
-    def embed(self, chunks):
+    def embed(self, chunks, max_concurrency=None):
 
         chunk_texts = [chunk["text"] for chunk in chunks]
-        embeddings = self.model.embed(chunk_texts)
+        embeddings = self.model.embed_in_batches(chunk_texts, max_concurrency=max_concurrency)
 
         for i, chunk in enumerate(chunks):
-            chunk["embedding"] = embeddings.data[i].embedding
-        
+            chunk["embedding"] = embeddings[i]
+
         return chunks
 
-    
\ No newline at end of file
+
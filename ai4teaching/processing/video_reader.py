@@ -54,8 +54,8 @@ class VideoReader(DocumentReader):
     
     def _transcribe_audio(self, audio_file):
         
-        from openai import OpenAI
-        client = OpenAI()
+        from ai4teaching import get_openai_client
+        client = get_openai_client()
         audio = open(audio_file, "rb")
         response = client.audio.transcriptions.create(
             model="whisper-1", 
@@ -1 +1 @@
-from ai4teaching.utils.utils import log, make_sure_directory_exists
\ No newline at end of file
+from ai4teaching.utils.utils import log, make_sure_directory_exists, count_tokens, track_usage, record_usage
\ No newline at end of file
@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import threading
+import time
+from ai4teaching.utils import log, make_sure_directory_exists
+
+class SQLiteLRUStore:
+    '''
+    Persistent key-value store in a SQLite table, the base of the embedding and grading
+    caches. Values are blobs, keys are strings. When the store grows beyond max_entries,
+    the least recently used entries are evicted. WAL mode lets several processes share
+    the file. Hits, misses and evictions are counted for get_stats().
+    '''
+    def __init__(self, path, table_name, max_entries=None, name="cache"):
+        self.path = os.path.abspath(path)
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self.name = name
+
+        make_sure_directory_exists(os.path.dirname(self.path))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                last_accessed REAL NOT NULL
+            )""")
+        self._connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_last_accessed ON {self.table_name} (last_accessed)")
+        self._connection.commit()
+
+        log(f"Using {self.name} >{self.path}< with {self.get_size()} entries", type="debug")
+
+    '''
+    Returns a list with the stored value for each key or None if the key is not stored
+    '''
+    def get_values(self, keys):
+        found = {}
+
+        with self._lock:
+            # Query in slices to stay below SQLite's limit for host parameters
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                key_slice = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(key_slice))
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM {self.table_name} WHERE key IN ({placeholders})",
+                    key_slice
+                ).fetchall()
+                found.update(rows)
+
+            # Mark the found entries as recently used
+            if len(found) > 0:
+                now = time.time()
+                self._connection.executemany(
+                    f"UPDATE {self.table_name} SET last_accessed = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._connection.commit()
+
+            values = [found.get(key) for key in keys]
+            num_hits = sum(1 for value in values if value is not None)
+            self.hits += num_hits
+            self.misses += len(values) - num_hits
+
+        return values
+
+    '''
+    Stores the (key, value) pairs of items, replacing existing values
+    '''
+    def put_values(self, items):
+        now = time.time()
+        rows = [(key, value, now) for key, value in items]
+
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table_name} (key, value, last_accessed) VALUES (?, ?, ?)",
+                rows
+            )
+            self._evict_if_necessary()
+            self._connection.commit()
+
+    def get_size(self):
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            "path" : self.path,
+            "entries" : self.get_size(),
+            "max_entries" : self.max_entries,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "hit_rate" : self.hits / requests if requests > 0 else 0.0
+        }
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table_name}")
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    # Has to be called with the lock held
+    def _evict_if_necessary(self):
+        if self.max_entries is None:
+            return
+
+        size = self._connection.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+        num_to_evict = size - self.max_entries
+        if num_to_evict <= 0:
+            return
+
+        self._connection.execute(
+            f"DELETE FROM {self.table_name} WHERE rowid IN (SELECT rowid FROM {self.table_name} ORDER BY last_accessed ASC LIMIT ?)",
+            (num_to_evict,)
+        )
+        self.evictions += num_to_evict
+        log(f"Evicted {num_to_evict} least recently used entries from {self.name}", type="debug")
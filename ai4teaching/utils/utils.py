@@ -1,6 +1,9 @@
 import colorama
+import contextlib
+import contextvars
 import datetime
 import os
+import threading
 
 def log(message, type='info'):
     if type == 'info':
@@ -24,4 +27,46 @@ def log(message, type='info'):
 
 def make_sure_directory_exists(directory):
     if not os.path.exists(directory):
-        os.makedirs(directory)
\ No newline at end of file
+        os.makedirs(directory)
+
+def count_tokens(text, model_name="text-embedding-ada-002"):
+    # Use tiktoken if available, otherwise estimate with ~4 characters per token
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text) // 4 + 1
+
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+    return len(encoding.encode(text))
+
+
+# Usage counters of the current context, see track_usage()
+_usage = contextvars.ContextVar("usage", default=None)
+_usage_lock = threading.Lock()
+
+'''
+Counts the API calls and bytes written while the with block runs. Threads and tasks started
+from the block count as well, as long as they run in a copy of its context (asyncio tasks
+and asyncio.to_thread do this, for a ThreadPoolExecutor use contextvars.copy_context().run)
+'''
+@contextlib.contextmanager
+def track_usage():
+    usage = { "api_calls" : 0, "bytes_written" : 0 }
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+def record_usage(api_calls=0, bytes_written=0):
+    usage = _usage.get()
+    if usage is None:
+        return
+
+    with _usage_lock:
+        usage["api_calls"] += api_calls
+        usage["bytes_written"] += bytes_written
@@ -4,63 +4,79 @@ from ai4teaching import VectorDB
 from ai4teaching.utils import log
 
 class ChromaDB(VectorDB):
-    def __init__(self, path, embedding_model, reset=True):
-        super().__init__(embedding_model)
+    def __init__(self, path, embedding_model, reset=True, batch_size=1000):
+        super().__init__(embedding_model, path=path)
         self.client = chromadb.PersistentClient(path=path, settings=chromadb.config.Settings(allow_reset=True))
+        self.collections = {}
         if reset == True:
             self.client.reset()
+            self._delete_manifest()
 
-    def add_embedded_document_chunks(self, embedded_chunks_file_name, collection_name="documents"):
-
-        import json
-        with open(embedded_chunks_file_name, encoding="utf-8") as embedded_chunks_file:
-            embedded_chunks = json.load(embedded_chunks_file)
+        # Chroma rejects batches above its own limit, which depends on the SQLite build
+        max_batch_size = self.client.get_max_batch_size() if hasattr(self.client, "get_max_batch_size") else batch_size
+        self.batch_size = min(batch_size, max_batch_size)
 
+    def _add_embedded_chunks(self, embedded_chunks, embedded_chunks_file_name, collection_name):
         num_chunks = len(embedded_chunks["chunks"])
         if num_chunks == 0:
             log(f"No chunks found in >{embedded_chunks_file_name}<, skipping adding to ChromaDB", type="warning")
-            return
+            return 0
         
         log(f"Adding {num_chunks} chunks from >{embedded_chunks_file_name}< to ChromaDB", type="info")
 
         collection = self._get_collection(collection_name)
-        
-        for chunk in embedded_chunks["chunks"]:
-            collection.add(
-                documents=[chunk["content"]],
-                embeddings=[chunk["embedding"]],
-                metadatas=[chunk["metadata"]],
-                ids=[chunk["chunk_id"]]
+        chunks = embedded_chunks["chunks"]
+
+        # One upsert per batch instead of one transaction per chunk
+        for i in range(0, num_chunks, self.batch_size):
+            batch = chunks[i:i + self.batch_size]
+            collection.upsert(
+                documents=[chunk["content"] for chunk in batch],
+                embeddings=[chunk["embedding"] for chunk in batch],
+                metadatas=[chunk["metadata"] for chunk in batch],
+                ids=[chunk["chunk_id"] for chunk in batch]
                 )
 
-    def _get_collection(self, collection_name):
-        collections = self.client.list_collections()
-        collection_names = [collection.name for collection in collections]
+        return num_chunks
 
-        if collection_name in collection_names:
-            collection = self.client.get_collection(collection_name)
-        else:
-            collection = self.client.create_collection(collection_name)
+    def _delete_chunks(self, chunk_ids, collection_name):
+        if len(chunk_ids) == 0:
+            return
 
-        return collection
+        collection = self._get_collection(collection_name)
+        for i in range(0, len(chunk_ids), self.batch_size):
+            collection.delete(ids=chunk_ids[i:i + self.batch_size])
+
+    def _get_collection(self, collection_name):
+        # Collection handles stay valid, so they are looked up only once
+        if collection_name not in self.collections:
+            self.collections[collection_name] = self.client.get_or_create_collection(collection_name)
+
+        return self.collections[collection_name]
             
     def get_documents_count(self, collection_name="documents"):
         collection = self._get_collection(collection_name)
-        content = collection.get()
-        return len(content["ids"])
+        return collection.count()
     
-    def get_documents(self, collection_name="documents"):
+    def get_documents(self, collection_name="documents", include=None, limit=None, offset=0):
         collection = self._get_collection(collection_name)
-        content = collection.get()
+        content = collection.get(
+            include=include if include is not None else ["documents", "metadatas"],
+            limit=limit,
+            offset=offset if offset > 0 else None
+        )
         return content
     
     def query(self, query_prompt, n_results=2, collection_name="documents"):
           query_prompt_embedding = self.embedding_model.embed(query_prompt).data[0].embedding
 
+          return self.query_by_embeddings([query_prompt_embedding], n_results=n_results, collection_name=collection_name)
+
+    def query_by_embeddings(self, query_embeddings, n_results=2, collection_name="documents"):
           collection = self._get_collection(collection_name)
 
           results = collection.query(
-               query_embeddings=[query_prompt_embedding],
+               query_embeddings=[list(query_embedding) for query_embedding in query_embeddings],
                n_results=n_results,
                include=["distances", "documents", "metadatas"]
           ) 
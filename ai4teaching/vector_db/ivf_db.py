@@ -0,0 +1,228 @@
+import os
+import time
+import numpy as np
+from ai4teaching import NumpyVectorDB
+from ai4teaching.vector_db.numpy_db import _normalize, _top_k_rows
+from ai4teaching.utils import log
+
+class IVFIndex:
+    '''
+    Inverted file index for one collection. The embeddings are clustered with spherical
+    k-means into n_lists coarse cells; a query only scans the rows of the nprobe cells
+    whose centroids are closest to the query.
+    '''
+    def __init__(self, n_lists=None):
+        self.n_lists = n_lists
+        self.centroids = None
+        self.trained_size = 0
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, embeddings, n_iterations=10, max_training_points_per_list=256, seed=42):
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(len(embeddings))))
+        n_lists = min(n_lists, len(embeddings))
+
+        # Train on a sample, the centroids do not get much better with more points
+        rng = np.random.default_rng(seed)
+        n_training_points = min(len(embeddings), n_lists * max_training_points_per_list)
+        training_points = embeddings[rng.choice(len(embeddings), n_training_points, replace=False)]
+
+        centroids = training_points[rng.choice(len(training_points), n_lists, replace=False)].copy()
+        for _ in range(n_iterations):
+            labels = self._nearest_centroids(training_points, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, training_points)
+            counts = np.bincount(labels, minlength=n_lists)
+
+            # Reseed empty cells with random training points
+            empty = counts == 0
+            sums[empty] = training_points[rng.choice(len(training_points), int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        self.centroids = centroids
+        self.trained_size = len(embeddings)
+
+        # All rows have to be assigned to the new cells
+        self.assignments = self._nearest_centroids(embeddings, self.centroids)
+        self._lists = None
+
+    def assign(self, embeddings, rows):
+        if len(rows) == 0:
+            return
+
+        rows = np.asarray(rows)
+        if rows.max() >= len(self.assignments):
+            assignments = np.zeros(rows.max() + 1, dtype=np.int32)
+            assignments[:len(self.assignments)] = self.assignments
+            self.assignments = assignments
+
+        self.assignments[rows] = self._nearest_centroids(embeddings[rows], self.centroids)
+        self._lists = None
+
+    def move(self, moves, size):
+        for from_row, to_row in moves:
+            self.assignments[to_row] = self.assignments[from_row]
+        self.assignments = self.assignments[:size]
+        self._lists = None
+
+    def get_candidate_rows(self, query_embedding, nprobe):
+        lists = self._get_lists()
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_similarities = self.centroids @ query_embedding
+        probed_lists = np.argpartition(-centroid_similarities, nprobe - 1)[:nprobe]
+        return np.concatenate([lists[i] for i in probed_lists])
+
+    def _get_lists(self):
+        # Rebuild the inverted lists lazily after the assignments changed
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            boundaries = np.cumsum(np.bincount(self.assignments, minlength=len(self.centroids)))[:-1]
+            self._lists = np.split(order, boundaries)
+        return self._lists
+
+    def _nearest_centroids(self, embeddings, centroids, batch_size=8192):
+        labels = np.empty(len(embeddings), dtype=np.int32)
+        for start in range(0, len(embeddings), batch_size):
+            labels[start:start + batch_size] = np.argmax(embeddings[start:start + batch_size] @ centroids.T, axis=1)
+        return labels
+
+class IVFVectorDB(NumpyVectorDB):
+    '''
+    Approximate nearest neighbour search for large collections. Collections smaller
+    than min_train_size are searched exactly. Once a collection is large enough, an IVF
+    index is trained and updated incrementally as chunks are added. The index is
+    retrained when the collection has grown by retrain_growth_factor since the last
+    training. nprobe trades recall for latency, see evaluate_recall().
+    '''
+    def __init__(self, path, embedding_model, reset=True, n_lists=None, nprobe=8, min_train_size=10000, retrain_growth_factor=2.0, auto_persist=None):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_growth_factor = retrain_growth_factor
+        self.indexes = {}
+        super().__init__(path, embedding_model, reset=reset, auto_persist=auto_persist)
+
+    def set_nprobe(self, nprobe):
+        self.nprobe = nprobe
+
+    def persist(self, collection_name="documents"):
+        if self.path is None:
+            return
+
+        with self._lock:
+            super().persist(collection_name)
+
+            index = self._get_index(collection_name)
+            if index.is_trained():
+                np.savez(self._get_index_file(collection_name), centroids=index.centroids, trained_size=index.trained_size)
+
+    '''
+    Compares the approximate search with exact search for different nprobe values.
+    Uses the given query embeddings or, if None, a sample of the stored embeddings.
+    Returns a list with recall@n_results and the mean latency in milliseconds per nprobe.
+    '''
+    def evaluate_recall(self, query_embeddings=None, n_queries=100, n_results=10, nprobe_values=(1, 2, 4, 8, 16, 32), collection_name="documents"):
+        with self._lock:
+            return self._evaluate_recall_locked(query_embeddings, n_queries, n_results, nprobe_values, collection_name)
+
+    def _evaluate_recall_locked(self, query_embeddings, n_queries, n_results, nprobe_values, collection_name):
+        collection = self._get_collection(collection_name)
+        index = self._get_index(collection_name)
+
+        if not index.is_trained():
+            log(f"IVF index for collection >{collection_name}< is not trained yet, all queries are exact", type="warning")
+            return []
+
+        if query_embeddings is None:
+            rng = np.random.default_rng(0)
+            query_embeddings = collection.get_embeddings()[rng.choice(collection.size, min(n_queries, collection.size), replace=False)]
+        query_embeddings = _normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        k = min(n_results, collection.size)
+
+        start = time.perf_counter()
+        exact_results = [set(rows) for rows, _ in NumpyVectorDB._search(self, collection, query_embeddings, k)]
+        exact_latency_ms = (time.perf_counter() - start) * 1000 / len(query_embeddings)
+
+        report = []
+        for nprobe in nprobe_values:
+            start = time.perf_counter()
+            approximate_results = [self._search_one(collection, index, query_embedding, k, nprobe)[0] for query_embedding in query_embeddings]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(query_embeddings)
+
+            found = sum(len(exact & set(rows)) for exact, rows in zip(exact_results, approximate_results))
+            recall = found / sum(len(exact) for exact in exact_results)
+
+            report.append({ "nprobe" : nprobe, "recall" : recall, "latency_ms" : latency_ms, "exact_latency_ms" : exact_latency_ms })
+            log(f"nprobe={nprobe}: recall@{k}={recall:.3f}, {latency_ms:.2f} ms per query (exact: {exact_latency_ms:.2f} ms)", type="info")
+
+        return report
+
+    def _search(self, collection, query_embeddings, k):
+        index = self._get_index(collection.name)
+        if not index.is_trained():
+            return super()._search(collection, query_embeddings, k)
+
+        return [self._search_one(collection, index, query_embedding, k, self.nprobe) for query_embedding in query_embeddings]
+
+    def _search_one(self, collection, index, query_embedding, k, nprobe):
+        candidate_rows = index.get_candidate_rows(query_embedding, nprobe)
+        if len(candidate_rows) == 0:
+            return candidate_rows, np.zeros(0, dtype=np.float32)
+
+        similarities = collection.get_embeddings()[candidate_rows] @ query_embedding
+        top = _top_k_rows(similarities[np.newaxis, :], min(k, len(candidate_rows)))[0]
+        return candidate_rows[top], similarities[top]
+
+    def _on_rows_written(self, collection, rows):
+        index = self._get_index(collection.name)
+        embeddings = collection.get_embeddings()
+
+        if not index.is_trained():
+            if collection.size >= self.min_train_size:
+                self._train_index(collection, index)
+        elif collection.size >= index.trained_size * self.retrain_growth_factor:
+            self._train_index(collection, index)
+        else:
+            index.assign(embeddings, rows)
+
+    def _on_rows_deleted(self, collection, moves):
+        index = self._get_index(collection.name)
+        if index.is_trained():
+            index.move(moves, collection.size)
+
+    def _train_index(self, collection, index):
+        start = time.perf_counter()
+        index.train(collection.get_embeddings())
+        log(f"Trained IVF index with {len(index.centroids)} lists on {collection.size} chunks of collection >{collection.name}< in {time.perf_counter() - start:.1f} s", type="info")
+
+    def _get_index(self, collection_name):
+        if collection_name not in self.indexes:
+            self.indexes[collection_name] = IVFIndex(self.n_lists)
+        return self.indexes[collection_name]
+
+    def _get_index_file(self, collection_name):
+        return os.path.join(self.path, f"{collection_name}.ivf.npz")
+
+    def _load_persisted_collections(self):
+        # Load the trained centroids first, so that loading the rows only assigns them to cells
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".ivf.npz"):
+                continue
+
+            collection_name = file_name[:-len(".ivf.npz")]
+            with np.load(self._get_index_file(collection_name)) as index_file:
+                index = self._get_index(collection_name)
+                index.centroids = index_file["centroids"]
+                index.trained_size = int(index_file["trained_size"])
+
+        super()._load_persisted_collections()
+
+    def _delete_persisted_collections(self):
+        for file_name in os.listdir(self.path):
+            if file_name.endswith(".ivf.npz"):
+                os.remove(os.path.join(self.path, file_name))
+
+        super()._delete_persisted_collections()
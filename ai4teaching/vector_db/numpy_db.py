@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import numpy as np
+from ai4teaching import VectorDB
+from ai4teaching.utils import log, make_sure_directory_exists
+
+class NumpyCollection:
+    '''
+    Stores the L2-normalised float32 embeddings of a collection in one contiguous
+    matrix. The matrix grows by doubling its capacity, so appending is amortized O(1).
+    '''
+    def __init__(self, name, dimension=None):
+        self.name = name
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.row_for_id = {}
+        self.size = 0
+        self.matrix = np.zeros((0, dimension or 0), dtype=np.float32)
+
+    '''
+    Adds or replaces the given chunks and returns the rows that were written
+    '''
+    def upsert(self, ids, documents, metadatas, embeddings):
+        embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+        self._ensure_capacity(self.size + len(ids), embeddings.shape[1])
+
+        written_rows = []
+        for id, document, metadata, embedding in zip(ids, documents, metadatas, embeddings):
+            row = self.row_for_id.get(id)
+            if row is None:
+                row = self.size
+                self.size += 1
+                self.row_for_id[id] = row
+                self.ids.append(id)
+                self.documents.append(document)
+                self.metadatas.append(metadata)
+            else:
+                self.documents[row] = document
+                self.metadatas[row] = metadata
+            self.matrix[row] = embedding
+            written_rows.append(row)
+
+        return written_rows
+
+    '''
+    Deletes the given ids. The last row is moved into each freed row so that the matrix
+    stays contiguous. Returns the list of (from_row, to_row) moves.
+    '''
+    def delete(self, ids):
+        moves = []
+        for id in ids:
+            row = self.row_for_id.pop(id, None)
+            if row is None:
+                continue
+
+            last_row = self.size - 1
+            if row != last_row:
+                self.matrix[row] = self.matrix[last_row]
+                self.ids[row] = self.ids[last_row]
+                self.documents[row] = self.documents[last_row]
+                self.metadatas[row] = self.metadatas[last_row]
+                self.row_for_id[self.ids[row]] = row
+                moves.append((last_row, row))
+
+            self.ids.pop()
+            self.documents.pop()
+            self.metadatas.pop()
+            self.size -= 1
+
+        return moves
+
+    def get_embeddings(self):
+        return self.matrix[:self.size]
+
+    def _ensure_capacity(self, required_rows, dimension):
+        if self.matrix.shape[1] != dimension:
+            if self.size > 0:
+                raise ValueError(f"Embedding dimension {dimension} does not match dimension {self.matrix.shape[1]} of collection >{self.name}<")
+            self.matrix = np.zeros((0, dimension), dtype=np.float32)
+
+        if required_rows <= self.matrix.shape[0]:
+            return
+
+        capacity = max(required_rows, 2 * self.matrix.shape[0], 1024)
+        matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        self.matrix = matrix
+
+class NumpyVectorDB(VectorDB):
+    '''
+    In-process vector database for corpora that fit into memory. Queries are answered
+    with exact search: one matrix multiplication plus argpartition for the top-k rows.
+    Distances are squared L2 distances between normalised vectors (like Chroma's default).
+    If a path is given, the collections are persisted to and loaded from that directory.
+    Added chunks are only persisted automatically if auto_persist is set, by default when
+    the collections are not reset (as in sync mode); persist() and syncs always write.
+    Reads and writes are serialized by a lock, so a knowledge base worker can add documents
+    while other threads query.
+    '''
+    def __init__(self, path, embedding_model, reset=True, auto_persist=None):
+        super().__init__(embedding_model, path=path)
+        self.collections = {}
+        self._lock = threading.RLock()
+
+        # Persisted collections are deleted on the next start if reset is set, writing them is wasted
+        self.auto_persist = not reset if auto_persist is None else auto_persist
+
+        if self.path is not None:
+            make_sure_directory_exists(self.path)
+            if reset == True:
+                self._delete_persisted_collections()
+                self._delete_manifest()
+            else:
+                self._load_persisted_collections()
+
+    def add_embedded_document_chunks(self, embedded_chunks_file_name, collection_name="documents"):
+        super().add_embedded_document_chunks(embedded_chunks_file_name, collection_name)
+        self._persist_changes(collection_name)
+
+    def _add_embedded_chunks(self, embedded_chunks, embedded_chunks_file_name, collection_name):
+        with self._lock:
+            return self._add_embedded_chunks_locked(embedded_chunks, embedded_chunks_file_name, collection_name)
+
+    def _add_embedded_chunks_locked(self, embedded_chunks, embedded_chunks_file_name, collection_name):
+        num_chunks = len(embedded_chunks["chunks"])
+        if num_chunks == 0:
+            log(f"No chunks found in >{embedded_chunks_file_name}<, skipping adding to NumpyVectorDB", type="warning")
+            return 0
+
+        log(f"Adding {num_chunks} chunks from >{embedded_chunks_file_name}< to NumpyVectorDB", type="info")
+
+        collection = self._get_collection(collection_name)
+        chunks = embedded_chunks["chunks"]
+        written_rows = collection.upsert(
+            ids=[chunk["chunk_id"] for chunk in chunks],
+            documents=[chunk["content"] for chunk in chunks],
+            metadatas=[chunk["metadata"] for chunk in chunks],
+            embeddings=[chunk["embedding"] for chunk in chunks]
+        )
+        self._on_rows_written(collection, written_rows)
+
+        return num_chunks
+
+    def get_documents_count(self, collection_name="documents"):
+        with self._lock:
+            return self._get_collection(collection_name).size
+
+    def get_documents(self, collection_name="documents", include=None, limit=None, offset=0):
+        include = include if include is not None else ["documents", "metadatas"]
+        with self._lock:
+            collection = self._get_collection(collection_name)
+            end = collection.size if limit is None else min(collection.size, offset + limit)
+
+            return {
+                "ids" : collection.ids[offset:end],
+                "embeddings" : collection.get_embeddings()[offset:end].tolist() if "embeddings" in include else None,
+                "documents" : collection.documents[offset:end] if "documents" in include else None,
+                "metadatas" : collection.metadatas[offset:end] if "metadatas" in include else None
+            }
+
+    def query(self, query_prompt, n_results=2, collection_name="documents"):
+        return self.query_batch([query_prompt], n_results=n_results, collection_name=collection_name)
+
+    '''
+    Answers several queries with one embeddings request and one matrix multiplication.
+    The result has the same structure as for query(), with one list per query prompt.
+    '''
+    def query_batch(self, query_prompts, n_results=2, collection_name="documents"):
+        response = self.embedding_model.embed(query_prompts)
+        query_embeddings = np.asarray([d.embedding for d in response.data], dtype=np.float32)
+        return self.query_by_embeddings(query_embeddings, n_results=n_results, collection_name=collection_name)
+
+    def query_by_embeddings(self, query_embeddings, n_results=2, collection_name="documents"):
+        query_embeddings = _normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        with self._lock:
+            return self._query_by_embeddings_locked(query_embeddings, n_results, collection_name)
+
+    def _query_by_embeddings_locked(self, query_embeddings, n_results, collection_name):
+        collection = self._get_collection(collection_name)
+
+        results = { "ids" : [], "distances" : [], "documents" : [], "metadatas" : [] }
+
+        k = min(n_results, collection.size)
+        if k == 0:
+            for _ in range(len(query_embeddings)):
+                for key in results:
+                    results[key].append([])
+            return results
+
+        for rows, similarities in self._search(collection, query_embeddings, k):
+            results["ids"].append([collection.ids[row] for row in rows])
+            results["distances"].append([max(0.0, float(2.0 - 2.0 * similarity)) for similarity in similarities])
+            results["documents"].append([collection.documents[row] for row in rows])
+            results["metadatas"].append([collection.metadatas[row] for row in rows])
+
+        return results
+
+    '''
+    Returns a (rows, similarities) tuple with the k best rows for each query embedding
+    '''
+    def _search(self, collection, query_embeddings, k):
+        similarities = query_embeddings @ collection.get_embeddings().T
+        top_rows = _top_k_rows(similarities, k)
+        return [(rows, query_similarities[rows]) for query_similarities, rows in zip(similarities, top_rows)]
+
+    def _delete_chunks(self, chunk_ids, collection_name):
+        with self._lock:
+            collection = self._get_collection(collection_name)
+            moves = collection.delete(chunk_ids)
+            self._on_rows_deleted(collection, moves)
+
+    def _on_rows_written(self, collection, rows):
+        # Hook for index structures that need to know about new or changed embeddings
+        pass
+
+    def _on_rows_deleted(self, collection, moves):
+        # Hook for index structures, rows were moved from one position to another
+        pass
+
+    def _persist_changes(self, collection_name):
+        if self.auto_persist:
+            self.persist(collection_name)
+
+    def persist(self, collection_name="documents"):
+        if self.path is None:
+            return
+
+        with self._lock:
+            collection = self._get_collection(collection_name)
+            matrix_file, records_file = self._get_collection_files(collection_name)
+
+            np.save(matrix_file, collection.get_embeddings())
+            with open(records_file, "w", encoding="utf-8") as json_file:
+                json.dump({ "ids" : collection.ids, "documents" : collection.documents, "metadatas" : collection.metadatas }, json_file, ensure_ascii=False)
+
+    def _get_collection(self, collection_name):
+        if collection_name not in self.collections:
+            self.collections[collection_name] = NumpyCollection(collection_name)
+        return self.collections[collection_name]
+
+    def _get_collection_files(self, collection_name):
+        return os.path.join(self.path, f"{collection_name}.npy"), os.path.join(self.path, f"{collection_name}.json")
+
+    def _load_persisted_collections(self):
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".npy"):
+                continue
+
+            collection_name = file_name[:-len(".npy")]
+            matrix_file, records_file = self._get_collection_files(collection_name)
+            if not os.path.isfile(records_file):
+                log(f"Records file >{records_file}< for collection >{collection_name}< not found, skipping", type="warning")
+                continue
+
+            with open(records_file, encoding="utf-8") as json_file:
+                records = json.load(json_file)
+
+            embeddings = np.load(matrix_file)
+            collection = self._get_collection(collection_name)
+            if len(records["ids"]) > 0:
+                written_rows = collection.upsert(records["ids"], records["documents"], records["metadatas"], embeddings)
+                self._on_rows_written(collection, written_rows)
+
+            log(f"Loaded {collection.size} chunks for collection >{collection_name}< from >{self.path}<", type="debug")
+
+    def _delete_persisted_collections(self):
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".npy"):
+                continue
+
+            for collection_file in self._get_collection_files(file_name[:-len(".npy")]):
+                if os.path.isfile(collection_file):
+                    os.remove(collection_file)
+
+def _normalize(embeddings):
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+def _top_k_rows(similarities, k):
+    # argpartition finds the k best rows in O(n), only those k rows are sorted
+    if k < similarities.shape[1]:
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(similarities.shape[1]), (similarities.shape[0], 1))
+
+    candidate_similarities = np.take_along_axis(similarities, candidates, axis=1)
+    order = np.argsort(-candidate_similarities, axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
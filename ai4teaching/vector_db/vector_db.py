@@ -1,7 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import time
+from ai4teaching.utils import log
+
 class VectorDB:
-    def __init__(self, embedding_model):
+
+    MANIFEST_FILE_NAME = "ai4teaching_manifest.json"
+
+    def __init__(self, embedding_model, path=None):
         self.client = None
         self.embedding_model = embedding_model
+        self.path = path
+
+        # { collection_name : { file_name : { "fingerprint" : ..., "chunk_ids" : [...] } } } of the files added in this process
+        self.loaded_files = {}
+
+    '''
+    Adds the chunks of an embedded chunks file. If the file was added before, the chunks
+    that are no longer part of it are deleted, chunk ids change with the chunk's content.
+    '''
+    def add_embedded_document_chunks(self, embedded_chunks_file_name, collection_name="documents"):
+        embedded_chunks = self._load_embedded_chunks_file(embedded_chunks_file_name)
+
+        loaded_file = self.loaded_files.get(collection_name, {}).get(os.path.abspath(embedded_chunks_file_name))
+        if loaded_file is not None:
+            chunk_ids = set(chunk["chunk_id"] for chunk in embedded_chunks["chunks"])
+            removed_chunk_ids = [chunk_id for chunk_id in loaded_file["chunk_ids"] if chunk_id not in chunk_ids]
+            if len(removed_chunk_ids) > 0:
+                log(f"Deleting {len(removed_chunk_ids)} chunks that are no longer part of >{embedded_chunks_file_name}<", type="info")
+                self._delete_chunks(removed_chunk_ids, collection_name)
+
+        self._add_embedded_chunks(embedded_chunks, embedded_chunks_file_name, collection_name)
+        self._remember_loaded_file(embedded_chunks_file_name, embedded_chunks, collection_name)
+
+    '''
+    Returns True if the file was added to the collection and did not change since
+    '''
+    def is_file_loaded(self, embedded_chunks_file_name, collection_name="documents"):
+        file_name = os.path.abspath(embedded_chunks_file_name)
+        loaded_file = self.loaded_files.get(collection_name, {}).get(file_name)
+        return loaded_file is not None and os.path.isfile(file_name) and loaded_file["fingerprint"] == self._get_file_fingerprint(file_name)
+
+    '''
+    Adds the chunks of many embedded chunks files. With prefetch, a background thread
+    parses the next file while the chunks of the current file are written.
+    Returns the number of added chunks and logs the throughput.
+    '''
+    def add_embedded_document_chunks_files(self, embedded_chunks_file_names, collection_name="documents", prefetch=True):
+        start = time.perf_counter()
+        num_chunks = 0
+
+        if prefetch and len(embedded_chunks_file_names) > 1:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_file = executor.submit(self._load_embedded_chunks_file, embedded_chunks_file_names[0])
+                for i, embedded_chunks_file_name in enumerate(embedded_chunks_file_names):
+                    embedded_chunks = next_file.result()
+                    if i + 1 < len(embedded_chunks_file_names):
+                        next_file = executor.submit(self._load_embedded_chunks_file, embedded_chunks_file_names[i + 1])
+                    num_chunks += self._add_embedded_chunks(embedded_chunks, embedded_chunks_file_name, collection_name)
+                    self._remember_loaded_file(embedded_chunks_file_name, embedded_chunks, collection_name)
+        else:
+            for embedded_chunks_file_name in embedded_chunks_file_names:
+                embedded_chunks = self._load_embedded_chunks_file(embedded_chunks_file_name)
+                num_chunks += self._add_embedded_chunks(embedded_chunks, embedded_chunks_file_name, collection_name)
+                self._remember_loaded_file(embedded_chunks_file_name, embedded_chunks, collection_name)
+
+        # Once for all files
+        self._persist_changes(collection_name)
+
+        duration = time.perf_counter() - start
+        chunks_per_second = num_chunks / duration if duration > 0 else 0.0
+        log(f"Added {num_chunks} chunks from {len(embedded_chunks_file_names)} files in {duration:.2f} s ({chunks_per_second:.0f} chunks/s)", type="info")
+
+        return num_chunks
+
+    '''
+    Brings the collection in line with the given embedded chunks files, using a manifest
+    of the files and chunks that were added before. Only new or changed files are loaded,
+    and of those only new or changed chunks are written. Chunks of files that are no longer
+    in the list are deleted. An unchanged corpus only costs one stat() call per file.
+    '''
+    def sync_embedded_chunks_files(self, embedded_chunks_file_names, collection_name="documents"):
+        if self.path is None:
+            log(f"Vector database has no path for a manifest, adding all files", type="warning")
+            return self.add_embedded_document_chunks_files(embedded_chunks_file_names, collection_name)
+
+        start = time.perf_counter()
+        manifest = self._load_manifest()
+        entries = manifest.setdefault(collection_name, {})
+
+        embedded_chunks_file_names = [os.path.abspath(file_name) for file_name in embedded_chunks_file_names]
+        num_added = num_updated = num_deleted = num_unchanged = 0
+
+        # Delete the chunks of files that are no longer part of the knowledge base
+        for file_name in list(entries.keys()):
+            if file_name not in embedded_chunks_file_names:
+                log(f"Deleting chunks of >{file_name}< from vector database", type="info")
+                self._delete_chunks(list(entries[file_name]["chunks"].keys()), collection_name)
+                del entries[file_name]
+                self.loaded_files.get(collection_name, {}).pop(file_name, None)
+                num_deleted += 1
+
+        for file_name in embedded_chunks_file_names:
+            fingerprint = self._get_file_fingerprint(file_name)
+            entry = entries.get(file_name)
+
+            if entry is not None and entry["fingerprint"] == fingerprint:
+                self.loaded_files.setdefault(collection_name, {})[file_name] = { "fingerprint" : fingerprint, "chunk_ids" : list(entry["chunks"].keys()) }
+                num_unchanged += 1
+                continue
+
+            embedded_chunks = self._load_embedded_chunks_file(file_name)
+            chunk_hashes = { chunk["chunk_id"] : self._hash_chunk(chunk) for chunk in embedded_chunks["chunks"] }
+
+            if entry is not None:
+                # Only write new or changed chunks and delete chunks that do not exist anymore
+                previous_chunk_hashes = entry["chunks"]
+                removed_chunk_ids = [chunk_id for chunk_id in previous_chunk_hashes if chunk_id not in chunk_hashes]
+                self._delete_chunks(removed_chunk_ids, collection_name)
+
+                changed_chunks = [chunk for chunk in embedded_chunks["chunks"] if previous_chunk_hashes.get(chunk["chunk_id"]) != chunk_hashes[chunk["chunk_id"]]]
+                log(f"Updating >{file_name}<: {len(changed_chunks)} new or changed, {len(removed_chunk_ids)} removed, {len(chunk_hashes) - len(changed_chunks)} unchanged chunks", type="info")
+
+                embedded_chunks = embedded_chunks | { "chunks" : changed_chunks }
+                num_updated += 1
+            else:
+                num_added += 1
+
+            if len(embedded_chunks["chunks"]) > 0:
+                self._add_embedded_chunks(embedded_chunks, file_name, collection_name)
+            entries[file_name] = { "document_id" : embedded_chunks.get("id"), "fingerprint" : fingerprint, "chunks" : chunk_hashes }
+            self.loaded_files.setdefault(collection_name, {})[file_name] = { "fingerprint" : fingerprint, "chunk_ids" : list(chunk_hashes.keys()) }
+
+        if num_added + num_updated + num_deleted > 0:
+            self.persist(collection_name)
+            self._save_manifest(manifest)
+
+        log(f"Synchronized vector database in {(time.perf_counter() - start) * 1000:.0f} ms: {num_added} added, {num_updated} updated, {num_deleted} deleted, {num_unchanged} unchanged files", type="info")
+
+    def persist(self, collection_name="documents"):
+        pass
+
+    # Called after chunks were added outside of a sync, databases may skip persisting then
+    def _persist_changes(self, collection_name):
+        self.persist(collection_name)
+
+    def query(self, query_prompt, n_results=2, collection_name="documents"):
+        pass
+
+    '''
+    Like query(), for embeddings that were already computed. Returns one result list per embedding.
+    '''
+    def query_by_embeddings(self, query_embeddings, n_results=2, collection_name="documents"):
+        pass
+
+    '''
+    Returns the ids and the fields in include ("documents", "metadatas", "embeddings") of
+    the chunks, optionally only limit chunks starting at offset. Fields that are not
+    included are None.
+    '''
+    def get_documents(self, collection_name="documents", include=None, limit=None, offset=0):
+        pass
+
+    def get_documents_count(self, collection_name="documents"):
+        pass
+
+    '''
+    Writes the chunks of one loaded embedded chunks file, returns the number of chunks written
+    '''
+    def _add_embedded_chunks(self, embedded_chunks, embedded_chunks_file_name, collection_name):
+        return 0
+
+    def _delete_chunks(self, chunk_ids, collection_name):
+        pass
+
+    def _hash_chunk(self, chunk):
+        chunk_json = json.dumps([chunk["content"], chunk["metadata"], chunk["embedding"]], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(chunk_json.encode("utf-8")).hexdigest()[:16]
+
+    def _remember_loaded_file(self, embedded_chunks_file_name, embedded_chunks, collection_name):
+        file_name = os.path.abspath(embedded_chunks_file_name)
+        self.loaded_files.setdefault(collection_name, {})[file_name] = {
+            "fingerprint" : self._get_file_fingerprint(file_name),
+            "chunk_ids" : [chunk["chunk_id"] for chunk in embedded_chunks["chunks"]]
+        }
+
+    def _get_file_fingerprint(self, file_name):
+        stat = os.stat(file_name)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _get_manifest_file(self):
+        return os.path.join(self.path, VectorDB.MANIFEST_FILE_NAME)
+
+    def _load_manifest(self):
+        if not os.path.isfile(self._get_manifest_file()):
+            return {}
+
+        with open(self._get_manifest_file(), encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+
+    def _save_manifest(self, manifest):
+        with open(self._get_manifest_file(), "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file, ensure_ascii=False)
+
+    def _delete_manifest(self):
+        if self.path is not None and os.path.isfile(self._get_manifest_file()):
+            os.remove(self._get_manifest_file())
 
-    def query():
-        pass
\ No newline at end of file
+    def _load_embedded_chunks_file(self, embedded_chunks_file_name):
+        with open(embedded_chunks_file_name, encoding="utf-8") as embedded_chunks_file:
+            return json.load(embedded_chunks_file)
@@ -10,7 +10,9 @@ setup(
     url='https://github.com/winf-hsos/AI4Teaching',
     install_requires=[
         'openai',
+        'httpx',
         'chromadb',
+        'numpy',
         'pytube',
         'PyPDF2',
         'moviepy',